@@ -0,0 +1,196 @@
+from abstract_base_class import ModifierInterfaceClass, Modifier1, Modifier2, Modifier3
+
+import multiprocessing
+from multiprocessing import shared_memory
+import random
+import time
+from typing import Dict, Iterable, Iterator, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+class _SharedArray:
+    """NumPy array backed by a named shared memory block, created by the pool and attached by the workers"""
+    def __init__(self, shape: Tuple[int, ...], dtype, name: Optional[str] = None):
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        if name is None:
+            size = max(1, int(np.prod(shape)) * self.dtype.itemsize)
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.array = np.ndarray(shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    def __reduce__(self):
+        # Workers attach to the block by name instead of receiving a pickled copy
+        return _SharedArray, (self.shape, self.dtype, self.shm.name)
+
+    def close(self):
+        del self.array
+        self.shm.close()
+
+
+def _seed_sample(modifiers, seed: int, sequence_number: int):
+    """Same random draws for a sample whatever worker processes it"""
+    seed_sequence = np.random.SeedSequence([seed, sequence_number])
+    random.seed(int(seed_sequence.generate_state(1)[0]))
+    np.random.seed(seed_sequence.generate_state(1, dtype=np.uint32)[0])
+    for index, modifier in enumerate(modifiers):
+        if isinstance(getattr(modifier, 'rng', None), np.random.Generator):
+            modifier.rng = np.random.default_rng([seed, sequence_number, index])
+
+
+def _worker(modifiers, images: _SharedArray, boxes: _SharedArray, classes: _SharedArray,
+            task_queue, result_queue, seed: int):
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        sequence_number, slot, num_boxes = task
+        try:
+            _seed_sample(modifiers, seed, sequence_number)
+            image = images.array[slot]
+            sample_boxes = boxes.array[slot, :num_boxes] if num_boxes >= 0 else None
+            sample_classes = classes.array[slot, :num_boxes] if num_boxes >= 0 else None
+            for modifier in modifiers:
+                image, sample_boxes, sample_classes = modifier(image, sample_boxes, sample_classes)
+            if image.shape != images.array.shape[1:]:
+                raise ValueError(f"Modifiers changed the image shape to {image.shape}")
+            images.array[slot] = image
+            if sample_boxes is not None:
+                num_boxes = len(sample_boxes)
+                boxes.array[slot, :num_boxes] = sample_boxes
+                classes.array[slot, :num_boxes] = sample_classes
+            result_queue.put((sequence_number, slot, num_boxes, None))
+        except Exception as exception:
+            result_queue.put((sequence_number, slot, num_boxes, exception))
+    images.close()
+    boxes.close()
+    classes.close()
+
+
+class AugmentationPool:
+    """
+    Applies a chain of per sample modifiers (any ModifierInterfaceClass) in worker processes.
+    Images, boxes and classes go through shared memory ring buffers of num_slots samples, only slot
+    numbers are sent through the queues. Results are returned in submission order, and every sample
+    is augmented with random generators seeded from (seed, its sequence number).
+    """
+    def __init__(self, modifiers: Sequence, image_shape: Tuple[int, ...], image_dtype=np.uint8,
+                 max_boxes: int = 64, num_workers: int = 4, num_slots: Optional[int] = None, seed: int = 0):
+        for modifier in modifiers:
+            if not isinstance(modifier, ModifierInterfaceClass):
+                raise TypeError(f"{type(modifier).__name__} is not a ModifierInterfaceClass")
+        self.num_slots = num_slots if num_slots is not None else 4 * num_workers
+        self.max_boxes = max_boxes
+        self.images = _SharedArray((self.num_slots,) + tuple(image_shape), image_dtype)
+        self.boxes = _SharedArray((self.num_slots, max_boxes, 4), np.float64)
+        self.classes = _SharedArray((self.num_slots, max_boxes), np.int64)
+        self.task_queue = multiprocessing.Queue()
+        self.result_queue = multiprocessing.Queue()
+        self.workers = [
+            multiprocessing.Process(target=_worker, daemon=True,
+                                    args=(list(modifiers), self.images, self.boxes, self.classes,
+                                          self.task_queue, self.result_queue, seed))
+            for _ in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        for _ in self.workers:
+            self.task_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        for shared_array in (self.images, self.boxes, self.classes):
+            shared_array.close()
+            shared_array.shm.unlink()
+
+    def _submit(self, sequence_number: int, slot: int, image, boxes, classes):
+        self.images.array[slot] = image
+        num_boxes = -1
+        if boxes is not None:
+            num_boxes = len(boxes)
+            if num_boxes > self.max_boxes:
+                raise ValueError(f"{num_boxes} boxes exceed max_boxes = {self.max_boxes}")
+            self.boxes.array[slot, :num_boxes] = boxes
+            self.classes.array[slot, :num_boxes] = classes
+        self.task_queue.put((sequence_number, slot, num_boxes))
+
+    def _collect(self, slot: int, num_boxes: int):
+        """Copies a result out of its slot so that the slot can be reused"""
+        image = self.images.array[slot].copy()
+        if num_boxes < 0:
+            return image, None, None
+        return image, self.boxes.array[slot, :num_boxes].copy(), self.classes.array[slot, :num_boxes].copy()
+
+    def map(self, samples: Iterable[Tuple[np.ndarray, Optional[np.ndarray], Optional[np.ndarray]]]) -> Iterator:
+        """Yields the augmented (image, boxes, classes) of every sample, in submission order"""
+        samples = iter(samples)
+        free_slots = list(range(self.num_slots))
+        finished: Dict[int, Tuple[int, int]] = {}
+        num_submitted = 0
+        num_received = 0
+        next_sequence_number = 0
+        exhausted = False
+        try:
+            while True:
+                while free_slots and not exhausted:
+                    sample = next(samples, None)
+                    if sample is None:
+                        exhausted = True
+                        break
+                    self._submit(num_submitted, free_slots.pop(), *sample)
+                    num_submitted += 1
+                if next_sequence_number == num_submitted:
+                    return
+                while next_sequence_number not in finished:
+                    sequence_number, slot, num_boxes, exception = self.result_queue.get()
+                    num_received += 1
+                    if exception is not None:
+                        raise exception
+                    finished[sequence_number] = (slot, num_boxes)
+                slot, num_boxes = finished.pop(next_sequence_number)
+                yield self._collect(slot, num_boxes)
+                free_slots.append(slot)
+                next_sequence_number += 1
+        finally:
+            # Stopped early or failed: wait for the samples still in flight, otherwise the next map would
+            # take their results for its own and the workers would still be writing to its slots
+            for _ in range(num_submitted - num_received):
+                self.result_queue.get()
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    images = rng.integers(0, 256, (512, 128, 128, 3), dtype=np.uint8)
+    boxes = np.array([[10.0, 20.0, 30.0, 40.0], [50.0, 60.0, 70.0, 80.0]])
+    classes = np.array([1, 2])
+    samples = [(image, boxes, classes) for image in images]
+
+    for num_workers in (1, 4):
+        with AugmentationPool([Modifier2(), Modifier2()], images.shape[1:], num_workers=num_workers) as pool:
+            start = time.perf_counter()
+            results = list(pool.map(samples))
+            print(f"{num_workers} workers: {len(images) / (time.perf_counter() - start):,.0f} images/s")
+        assert all(np.array_equal(result[0], image) for result, image in zip(results, images))
+
+    # Modifier1 flips at random, the same samples are flipped whatever the number of workers
+    flipped = []
+    for num_workers in (1, 3):
+        with AugmentationPool([Modifier1()], images.shape[1:], num_workers=num_workers, seed=7) as pool:
+            flipped.append([result[1][0, 0] != boxes[0, 0] for result in pool.map(samples[:16])])
+    assert flipped[0] == flipped[1]
+
+    # A map stopped early leaves no stale result behind for the next one
+    images = np.full((5, 4, 4, 3), 100, dtype=np.uint8)
+    with AugmentationPool([Modifier3()], images.shape[1:], num_workers=2, num_slots=4) as pool:
+        for _ in pool.map((image, None, None) for image in images):
+            break
+        results = pool.map((image - 50, None, None) for image in images)
+        assert [int(result[0][0, 0, 0]) for result in results] == [51] * 5
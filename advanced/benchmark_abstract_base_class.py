@@ -0,0 +1,55 @@
+from abstract_base_class import ModifierInterfaceClass, Modifier1, Modifier2, NotModifier3
+
+import abc
+import inspect
+import timeit
+
+
+class LegacyModifierInterfaceClass(metaclass=abc.ABCMeta):
+    """The protocol check before caching: constructs the candidate and inspects it on every call"""
+    __slots__ = ()
+
+    @abc.abstractmethod
+    def __call__(self, image, boxes, classes):
+        pass
+
+    @classmethod
+    def __subclasshook__(cls, subclass):
+        if cls is LegacyModifierInterfaceClass:
+            if set(cls.__abstractmethods__) > set(dir(subclass)):
+                return False
+            try:
+                subclass()
+            except TypeError:
+                return False
+            names = list(inspect.signature(subclass.__call__).parameters)
+            return len(names) == 4 and names[0] == 'self' \
+                and names[1] in ('img', 'image', 'tensor', 'cvimage') \
+                and names[2] == 'boxes' and names[3] in ('labels', 'classes')
+        return NotImplemented
+
+
+def benchmark_isinstance(number: int = 100_000):
+    objects = [Modifier1(), Modifier2(), NotModifier3()]
+    for interface_class in (LegacyModifierInterfaceClass, ModifierInterfaceClass):
+        assert [isinstance(obj, interface_class) for obj in objects] == [True, True, False]
+
+    def check(interface_class, clear_abc_caches: bool):
+        def run():
+            for obj in objects:
+                if clear_abc_caches:
+                    # As after every abc.register or for classes created on the fly
+                    interface_class._abc_caches_clear()
+                isinstance(obj, interface_class)
+        seconds = min(timeit.repeat(run, number=number // len(objects), repeat=3))
+        return number / seconds
+
+    for clear_abc_caches in (False, True):
+        legacy = check(LegacyModifierInterfaceClass, clear_abc_caches)
+        cached = check(ModifierInterfaceClass, clear_abc_caches)
+        print(f"isinstance, abc caches {'cleared' if clear_abc_caches else 'kept'}: "
+              f"legacy {legacy:,.0f}/s, cached {cached:,.0f}/s, speedup {cached / legacy:.1f}x")
+
+
+if __name__ == "__main__":
+    benchmark_isinstance()
@@ -0,0 +1,44 @@
+from filter_xls_cerba import TestData
+
+import numpy as np
+import pandas as pd
+import timeit
+
+
+class SyntheticTestData(TestData):
+    def __init__(self, num_rows: int, num_groups: int, seed: int = 0):
+        self.key = 'Requisition Nr'
+        self.unique = 'Test'
+        self.print_col_names = [self.key, self.unique]
+        rng = np.random.default_rng(seed)
+        req_nrs = np.char.add("FC", rng.integers(0, num_groups, num_rows).astype(str))
+        tests = np.char.add("TEST ", rng.integers(0, 500, num_rows).astype(str))
+        self.data = pd.DataFrame({self.key: req_nrs, self.unique: tests})
+        self._preprocess_data()
+        self._index_data()
+
+
+def benchmark_group_lookup(num_rows: int = 1_000_000, num_groups: int = 100_000, num_lookups: int = 200):
+    test_data = SyntheticTestData(num_rows, num_groups)
+    keys = list(test_data.groups.keys())[:num_lookups]
+
+    def boolean_mask():
+        for key in keys:
+            test_data.data.loc[test_data.data[test_data.key] == key]
+
+    def group_index():
+        for key in keys:
+            test_data.get_rows_by_req_nr(key)
+
+    for key in keys:
+        expected = test_data.data.loc[test_data.data[test_data.key] == key]
+        assert expected.equals(test_data.get_rows_by_req_nr(key))
+
+    time_mask = min(timeit.repeat(boolean_mask, number=1, repeat=3))
+    time_index = min(timeit.repeat(group_index, number=1, repeat=3))
+    print(f"{num_lookups} lookups on {num_rows} rows / {num_groups} groups")
+    print(f"boolean mask: {time_mask:.4f} s, group index: {time_index:.4f} s, speedup: {time_mask / time_index:.1f}x")
+
+
+if __name__ == "__main__":
+    benchmark_group_lookup()
@@ -0,0 +1,92 @@
+from clean_header_includes import get_begin_end_block_indexes, get_matching_lines, \
+    sort_block_of_lines_matching_pattern
+from line_block_editor import LineBlockFile, edit_files, get_blocks, get_largest_block, get_matching_line_numbers
+
+from pathlib import Path
+import random
+import re
+import tempfile
+import timeit
+from typing import List
+
+pattern = r"traf_lib_include\(\"detection\" \"(.*)\"\)"
+compiled_pattern = re.compile(pattern)
+
+
+def generate_cmakelists(path_file: Path, num_lines: int, seed: int = 0):
+    """CMakeLists with blocks of traf_lib_include lines of random length between other commands"""
+    rng = random.Random(seed)
+    lines: List[str] = []
+    while len(lines) < num_lines:
+        for _ in range(rng.randint(1, 20)):
+            lines.append(f"set(VAR_{len(lines)} value)\n")
+        for _ in range(rng.randint(1, 200)):
+            lines.append(f'traf_lib_include("detection" "lib{rng.randint(0, 10_000)}")\n')
+    path_file.write_text("".join(lines))
+
+
+def legacy_include_libs(path_file: Path, new_includes: List[str]):
+    """The former Lib._include_libs_in_cmakelists, inserting the lines one at a time"""
+    lines, matching_lines = get_matching_lines(path_file, pattern)
+    _, begin_line_number, end_line_number = get_begin_end_block_indexes(matching_lines)
+    new_includes = sorted(set(lines[begin_line_number:end_line_number + 1] + new_includes), reverse=True)
+    lines = lines[0:begin_line_number] + lines[end_line_number + 1:]
+    for item in new_includes:
+        lines.insert(begin_line_number, item)
+    with open(path_file, 'w') as fp:
+        fp.write("".join(lines))
+
+
+def include_libs(path_file: Path, new_includes: List[str]):
+    line_block_file = LineBlockFile(path_file)
+    line_block_file.merge_into_largest_block(compiled_pattern, new_includes)
+    line_block_file.save()
+
+
+def benchmark(num_lines: int = 200_000, num_files: int = 32, repeat: int = 3):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path_file = Path(tmp_dir) / "CMakeLists.txt"
+        new_includes = [f'traf_lib_include("detection" "new{index}")\n' for index in range(500)]
+
+        def timed(function, *args) -> float:
+            generate_cmakelists(path_file, num_lines)
+            return min(timeit.repeat(lambda: function(*args), number=1, repeat=repeat))
+
+        # Both implementations produce the same file
+        generate_cmakelists(path_file, num_lines)
+        legacy_include_libs(path_file, new_includes)
+        expected = path_file.read_text()
+        generate_cmakelists(path_file, num_lines)
+        include_libs(path_file, new_includes)
+        assert path_file.read_text() == expected
+
+        lines = path_file.read_text().splitlines(keepends=True)
+        results = {
+            "detect largest block": (
+                timed(lambda: get_begin_end_block_indexes(get_matching_lines(path_file, pattern)[1])),
+                timed(lambda: get_largest_block(get_blocks(get_matching_line_numbers(
+                    LineBlockFile(path_file).lines, compiled_pattern))))),
+            "merge includes": (timed(legacy_include_libs, path_file, new_includes),
+                               timed(include_libs, path_file, new_includes)),
+            "sort blocks": (timed(sort_block_of_lines_matching_pattern, path_file, pattern),
+                            timed(lambda: edit_files([path_file], lambda f: f.sort_blocks(compiled_pattern)))),
+        }
+
+        path_files = [Path(tmp_dir) / f"CMakeLists_{index}.txt" for index in range(num_files)]
+        for index, path in enumerate(path_files):
+            generate_cmakelists(path, num_lines // num_files, seed=index)
+        results[f"merge includes, {num_files} files"] = (
+            min(timeit.repeat(lambda: [legacy_include_libs(path, new_includes) for path in path_files],
+                              number=1, repeat=repeat)),
+            min(timeit.repeat(lambda: edit_files(
+                path_files, lambda f: f.merge_into_largest_block(compiled_pattern, new_includes)),
+                number=1, repeat=repeat)))
+
+    print(f"{num_lines} lines, {len(lines)} after merging")
+    for name, (time_legacy, time_new) in results.items():
+        print(f"{name}: legacy {time_legacy:.4f} s, line_block_editor {time_new:.4f} s, "
+              f"speedup {time_legacy / time_new:.1f}x")
+
+
+if __name__ == "__main__":
+    benchmark()
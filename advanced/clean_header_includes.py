@@ -1,12 +1,26 @@
+from include_dependency_index import IncludeIndex
+import instrumentation
+from line_block_editor import LineBlockFile, write_text_atomic
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
 import logging
+import os
 from pathlib import Path
 import re
 import subprocess
 import shutil
-from typing import List, Tuple, Match, AnyStr
+from typing import Dict, FrozenSet, List, Optional, Tuple, Match, AnyStr
 
 dry_run = False
 clean_which_lib = "detection"  # or "xstream"
+max_parallel_libs = 4  # libs processed at the same time
+total_jobs = 16  # make jobs shared by the concurrent builds
+skip_unchanged_libs = True  # skip libs whose sources are unchanged since their last successful run
+rewrite_threads = 8  # threads reading and rewriting the sources of one lib
+persistent_build_trees = False  # keep the binary dirs between runs and configure only when CMakeLists.txt changed
+use_include_index = True  # re-parse only the sources changed since the last run, see include_dependency_index.py
 
 
 def get_files(parent_directory: Path) -> Tuple[List[Path], List[Path]]:
@@ -30,6 +44,24 @@ def glob_file_by_pattern(parent_directory: Path, pattern="*") -> List[Path]:
     return files
 
 
+def scan_files_by_suffixes(parent_directory: Path, suffixes: Tuple[str, ...]) -> List[Path]:
+    """Collect files matching any of the suffixes recursively, in a single os.scandir walk"""
+    files: List[Path] = []
+    directories = [str(parent_directory)]
+    while directories:
+        try:
+            entries = os.scandir(directories.pop())
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.name.endswith(suffixes) and entry.is_file():
+                    files.append(Path(entry.path))
+    return files
+
+
 def get_begin_end_block_indexes(list_matching_line_numbers: List[int]):
     """
     Returns a map of begin-end matching line number pairs.
@@ -110,11 +142,17 @@ class Lib:
     path_xstream_inc: Path = path_source_dir / "xstream" / "inc"
     list_names_detection_libs: List[str] = None
     list_names_xstream_libs: List[str] = None
+    set_names_detection_libs: FrozenSet[str] = frozenset()
+    set_names_xstream_libs: FrozenSet[str] = frozenset()
+    include_index: Optional[IncludeIndex] = None
+    patterns_traf_lib_include = {lib_type: re.compile(r"traf_lib_include\(\"" + lib_type + r"\" \"(.*)\"\)")
+                                 for lib_type in ("detection", "xstream")}
 
     @classmethod
     def get_list_names_detection_libs(cls):
         _, sub_directories = get_files(cls.path_detection_libs)
         cls.list_names_detection_libs = [full_path.name for full_path in sub_directories]
+        cls.set_names_detection_libs = frozenset(cls.list_names_detection_libs)
         logging.info(f"Detection libs count = {len(cls.list_names_detection_libs)}")
         logging.info(f", ".join(cls.list_names_detection_libs))
 
@@ -122,6 +160,7 @@ class Lib:
     def get_list_names_xstream_libs(cls):
         _, sub_directories = get_files(cls.path_xstream_libs)
         cls.list_names_xstream_libs = [full_path.name for full_path in sub_directories]
+        cls.set_names_xstream_libs = frozenset(cls.list_names_xstream_libs)
         logging.info(f"Xstream libs count = {len(cls.list_names_xstream_libs)}")
         logging.info(f", ".join(cls.list_names_xstream_libs))
 
@@ -131,6 +170,12 @@ class Lib:
         self.set_libs_not_included = set()
         self.lib_name = lib_name
         self.lib_type = lib_type
+        self.jobs = 16
+        self.passed = True
+        self.timings: Dict[str, float] = {}
+        # Files scanned and files changed per source tree by the include rewriting
+        self.include_stats: Dict[str, Tuple[int, int]] = {}
+        self.logger = logging.getLogger(f"{__name__}.{lib_name}")
         self.path_main_binary_dir: Path = Lib.path_binary_dir / lib_name / "Desktop" / "Release"
         if lib_type == "detection":
             self.path_main_lib: Path = Lib.path_detection_libs / lib_name
@@ -139,120 +184,163 @@ class Lib:
             self.path_main_lib: Path = Lib.path_xstream_libs / lib_name
             self.path_main_lib_inc: Path = Lib.path_xstream_inc / lib_name
         self.path_main_cmakelists: Path = self.path_main_lib / "CMakeLists.txt"
+        # The hash of CMakeLists.txt the persistent build tree was last configured with
+        self.path_cmakelists_hash: Path = self.path_main_binary_dir / "CMakeLists.txt.sha1"
+
+    def _get_cmakelists_hash(self) -> str:
+        return hashlib.sha1(self.path_main_cmakelists.read_bytes()).hexdigest()
+
+    def get_source_hash(self) -> str:
+        """Hash of the sources, headers and CMakeLists of the lib, including file names"""
+        source_files = glob_file_by_pattern(self.path_main_lib) + glob_file_by_pattern(self.path_main_lib_inc, "*.h")
+        sha = hashlib.sha1()
+        for path_file in sorted(path for path in source_files if path.is_file()):
+            sha.update(str(path_file).encode())
+            sha.update(path_file.read_bytes())
+        return sha.hexdigest()
 
     def _pre_process(self):
-        # rm -rf binary dir
-        shutil.rmtree(self.path_main_binary_dir.parent.parent, ignore_errors=True)
+        if not persistent_build_trees:
+            # rm -rf binary dir
+            shutil.rmtree(self.path_main_binary_dir.parent.parent, ignore_errors=True)
         # make binary dir
         self.path_main_binary_dir.mkdir(parents=True, exist_ok=True)
 
     def _cmake_load_cache(self):
+        if not self.path_main_cmakelists.exists():
+            self.passed = False
+            self.logger.critical(f"Failed load cache {self.lib_name}: no {self.path_main_cmakelists}")
+            return
+        path_cmakelists_hash = self.path_cmakelists_hash
+        # Only a persistent build tree is reused, a fresh one is configured whatever the hash
+        cmakelists_hash = self._get_cmakelists_hash() if persistent_build_trees else None
+        if cmakelists_hash is not None and (self.path_main_binary_dir / "CMakeCache.txt").exists() \
+                and path_cmakelists_hash.exists() and path_cmakelists_hash.read_text() == cmakelists_hash:
+            self.logger.critical(f"Reused load cache {self.lib_name}")
+            return
+
         args = "/usr/bin/cmake"
         args += " -S " + str(self.path_main_lib)
         args += " -B " + str(self.path_main_binary_dir)
         args += "  '-GCodeBlocks - Unix Makefiles' -DCMAKE_BUILD_TYPE:STRING=Release -DCMAKE_PROJECT_INCLUDE_BEFORE:PATH=/home/akadar/qtcreator-6.0.0/share/qtcreator/package-manager/auto-setup.cmake -DQT_QMAKE_EXECUTABLE:STRING=/usr/lib/x86_64-linux-gnu/qt4/bin/qmake -DCMAKE_PREFIX_PATH:STRING=/usr -DCMAKE_C_COMPILER:STRING=/usr/lib/ccache/gcc -DCMAKE_CXX_COMPILER:STRING=/usr/lib/ccache/g++"
         completed_process = subprocess.run(args, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
         if completed_process.returncode != 0:
-            logging.critical(f"Failed load cache {self.lib_name}")
-            logging.error(completed_process.stdout)
-        else:
-            logging.critical(f"Passed load cache {self.lib_name}")
-
-    def _clean_build(self):
-        args = "/usr/bin/cmake"
-        args += " --build " + str(self.path_main_binary_dir)
-        args += " --target clean"
-        completed_process = subprocess.run(args, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-        if completed_process.returncode != 0:
-            logging.critical(f"Failed target clean {self.lib_name}")
-            logging.error(completed_process.stdout)
+            self.passed = False
+            path_cmakelists_hash.unlink(missing_ok=True)
+            self.logger.critical(f"Failed load cache {self.lib_name}")
+            self.logger.error(completed_process.stdout)
         else:
-            logging.critical(f"Passed target clean {self.lib_name}")
+            if cmakelists_hash is not None:
+                path_cmakelists_hash.write_text(cmakelists_hash)
+            self.logger.critical(f"Passed load cache {self.lib_name}")
 
     def _build(self):
         args = "/usr/bin/cmake"
         args += " --build " + str(self.path_main_binary_dir)
-        args += " --target all -j 16"
+        args += f" --target all -j {self.jobs}"
         # completed_process = subprocess.run(args, shell=True, capture_output=True, text=True)
         completed_process = subprocess.run(args, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
         static_libs = glob_file_by_pattern(self.path_main_binary_dir, "*.a")
         if completed_process.returncode != 0 or not static_libs:
-            logging.critical(f"Failed target all {self.lib_name}")
-            logging.error(completed_process.stdout)
+            self.passed = False
+            self.logger.critical(f"Failed target all {self.lib_name}")
+            self.logger.error(completed_process.stdout)
         else:
+            if persistent_build_trees:
+                # cmake --build re-runs the configure step itself when CMakeLists.txt was edited
+                self.path_cmakelists_hash.write_text(self._get_cmakelists_hash())
             for static_lib in static_libs:
-                logging.critical(f"Made {static_lib}")
-            logging.critical(f"Passed target all {self.lib_name}")
+                self.logger.critical(f"Made {static_lib}")
+            self.logger.critical(f"Passed target all {self.lib_name}")
 
     def _post_process(self):
-        # rm -rf binary dir
-        shutil.rmtree(self.path_main_binary_dir.parent.parent, ignore_errors=True)
+        if not persistent_build_trees:
+            # rm -rf binary dir
+            shutil.rmtree(self.path_main_binary_dir.parent.parent, ignore_errors=True)
+
+    def _run_phases(self, *phases):
+        for phase, function in phases:
+            with instrumentation.timer(phase, self.timings):
+                function()
+
+    def prepare(self):
+        """Phases rewriting the sources and headers of the lib, which the libs including it compile against"""
+        # No clean target: the tree is either fresh or deliberately reused for an incremental build
+        self._run_phases(("pre_process", self._pre_process),
+                         ("configure", self._cmake_load_cache),
+                         ("rewrite_includes", self._process_header_includes),
+                         ("edit_cmakelists", self._include_libs_in_cmakelists))
+
+    def make(self):
+        self._run_phases(("build", self._build),
+                         ("post_process", self._post_process))
+        self.logger.critical("Timings: " + ", ".join(f"{phase} {seconds:.2f} s" for phase, seconds in self.timings.items()))
 
     def process(self):
-        self._pre_process()
-        self._cmake_load_cache()
-        self._clean_build()
-        self._process_header_includes()
-        if self.set_detection_libs_to_include:
-            self._include_libs_in_cmakelists("detection", self.set_detection_libs_to_include)
-        if self.set_xstream_libs_to_include:
-            self._include_libs_in_cmakelists("xstream", self.set_xstream_libs_to_include)
-        self._build()
-        self._post_process()
-
-    def _include_libs_in_cmakelists(self, lib_type, set_to_include):
-
-        # Find lines matching pattern
-        pattern = r"traf_lib_include\(\"" + lib_type + r"\" \"(.*)\"\)"
-        lines, matching_lines = get_matching_lines(self.path_main_cmakelists, pattern)
-
-        if not matching_lines:
-            logging.critical(f"No matching lines found for {lib_type} lib in {self.path_main_cmakelists} to include: ")
-            for item in set_to_include:
-                logging.critical(f"{item}")
+        self.prepare()
+        self.make()
+
+    def _include_libs_in_cmakelists(self):
+        if not self.path_main_cmakelists.exists():
+            # Already reported as a failed configure
             return
+        cmakelists = LineBlockFile(self.path_main_cmakelists)
+        for lib_type, set_to_include in (("detection", self.set_detection_libs_to_include),
+                                         ("xstream", self.set_xstream_libs_to_include)):
+            if not set_to_include:
+                continue
 
-        _, begin_line_number, end_line_number = get_begin_end_block_indexes(matching_lines)
+            # Add the includes to the largest block of lines matching the pattern
+            new_includes = [f'traf_lib_include("{lib_type}" "{item}")\n' for item in set_to_include]
+            block = cmakelists.merge_into_largest_block(Lib.patterns_traf_lib_include[lib_type], new_includes)
 
-        logging.debug(f"begin-end line numbers: {begin_line_number}, {end_line_number}")
+            if block is None:
+                self.logger.critical(f"No matching lines found for {lib_type} lib in {self.path_main_cmakelists} to include: ")
+                for item in set_to_include:
+                    self.logger.critical(f"{item}")
+                continue
 
-        # Prepare new includes
-        new_includes = lines[begin_line_number:end_line_number+1]
-        for item in set_to_include:
-            new_includes.append(f'traf_lib_include("{lib_type}" "{item}")\n')
+            self.logger.debug(f"begin-end line numbers: {block[0]}, {block[1]}")
 
-        new_includes = sorted(set(new_includes), reverse=True)
+        cmakelists.save()
 
-        # Remove includes
-        lines = lines[0:begin_line_number] + lines[end_line_number+1:]
+    def _process_header_includes(self):
+        trees = {
+            "lib": (self.path_main_lib, (".h", ".cpp")),
+            "inc": (self.path_main_lib_inc, (".h",)),
+        }
+        with ThreadPoolExecutor(max_workers=rewrite_threads) as executor:
+            for tree_name, (path_tree, suffixes) in trees.items():
+                files = scan_files_by_suffixes(path_tree, suffixes)
+                num_changed = sum(executor.map(self._do_replace_includes, files))
+                self.include_stats[tree_name] = (len(files), num_changed)
+                self.logger.critical(f"Includes in {tree_name} {path_tree}: "
+                                     f"{len(files)} files scanned, {num_changed} files changed")
+
+    def _add_lib_to_include(self, lib_name: str):
+        if lib_name in Lib.set_names_detection_libs and lib_name != self.lib_name:
+            self.set_detection_libs_to_include.add(lib_name)
+        elif lib_name in Lib.set_names_xstream_libs:
+            self.set_xstream_libs_to_include.add(lib_name)
+        else:
+            self.set_libs_not_included.add(lib_name)
+            # raise Exception(f"{lib_name} is neither a detection lib nor a xstream lib")
 
-        # Add lines
-        for item in new_includes:
-            lines.insert(begin_line_number, item)
+    def _do_replace_includes(self, path_source_file: Path) -> bool:
+        """Returns True when the file needs a rewrite (also in dry run)"""
+        self.logger.debug(path_source_file)
 
-        with open(self.path_main_cmakelists, 'w') as fp:
-            contents = "".join(lines)
-            fp.write(contents)
+        # Files unchanged since the last run, with the same known libs, were already rewritten: only their
+        # recorded libs are needed
+        if Lib.include_index is not None:
+            entry = Lib.include_index.get_unchanged_entry(path_source_file)
+            if entry is not None:
+                for lib_name in entry["libs"]:
+                    self._add_lib_to_include(lib_name)
+                return False
 
-    def _process_header_includes(self):
-        # private_h_files = glob_file_by_pattern(self.path_main_lib / "src", "*.h")
-        # cpp_files = glob_file_by_pattern(self.path_main_lib / "src", "*.cpp")
-        private_h_files = glob_file_by_pattern(self.path_main_lib, "*.h")
-        cpp_files = glob_file_by_pattern(self.path_main_lib, "*.cpp")
-        public_h_files = glob_file_by_pattern(self.path_main_lib_inc, "*.h")
-        all_files = []
-        all_files.extend(private_h_files)
-        all_files.extend(cpp_files)
-        all_files.extend(public_h_files)
-        for file in all_files:
-            self._do_replace_includes(file)
-
-    def _do_replace_includes(self, path_source_file: Path):
-        logging.debug(path_source_file)
-
-        allowed_libs = []
-        allowed_libs.extend(Lib.list_names_detection_libs)
-        allowed_libs.extend(Lib.list_names_xstream_libs)
+        found_libs: List[str] = []
+        stripped: List[Tuple[str, str]] = []
 
         def clean_include(match_obj: Match):
             """
@@ -264,27 +352,67 @@ class Lib:
             lib_name: str = match_obj.group(1)
             header: str = match_obj.group(2)
 
-            if lib_name in Lib.list_names_detection_libs and lib_name != self.lib_name:
-                self.set_detection_libs_to_include.add(lib_name)
-            elif lib_name in Lib.list_names_xstream_libs:
-                self.set_xstream_libs_to_include.add(lib_name)
-            else:
-                self.set_libs_not_included.add(lib_name)
-                # raise Exception(f"{lib_name} is neither a detection lib nor a xstream lib")
+            found_libs.append(lib_name)
+            self._add_lib_to_include(lib_name)
 
-            if lib_name in allowed_libs:
+            if lib_name in Lib.set_names_detection_libs or lib_name in Lib.set_names_xstream_libs:
                 replacement_string = '#include "' + header + '"\n'
+                stripped.append((lib_name, header))
 
             return replacement_string
 
-        pattern = r"#include \"(.*)/(.*)\"\n"
         # matches = re.findall(pattern, source_file.read_text())
         # print(matches)
         original_text = path_source_file.read_text()
-        new_text, number_of_subs_made = re.subn(pattern, clean_include, original_text)
-        logging.debug(f"Number of matches found = {number_of_subs_made}\n")
-        if not dry_run and new_text != original_text:
-            path_source_file.write_text(new_text)
+        new_text, number_of_subs_made = IncludeIndex.pattern.subn(clean_include, original_text)
+        self.logger.debug(f"Number of matches found = {number_of_subs_made}\n")
+        is_changed = new_text != original_text
+        if dry_run:
+            return is_changed
+        if is_changed:
+            write_text_atomic(path_source_file, new_text)
+        if Lib.include_index is not None:
+            Lib.include_index.record(path_source_file, self.lib_name, found_libs, new_text, stripped)
+        return is_changed
+
+
+def _load_state(path_state_file: Path) -> Dict[str, str]:
+    if path_state_file.exists():
+        return json.loads(path_state_file.read_text())
+    return {}
+
+
+def _process_lib(lib: Lib, path_log_dir: Path, stage: str) -> bool:
+    """Runs lib.prepare or lib.make, returns False when it raised: the lib is failed, the other libs go on"""
+    # Every lib logs to its own file instead of interleaving with the concurrent ones
+    path_log_dir.mkdir(parents=True, exist_ok=True)
+    handler = logging.FileHandler(path_log_dir / f"{lib.lib_name}.log", mode='w' if stage == "prepare" else 'a')
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    lib.logger.addHandler(handler)
+    lib.logger.setLevel(logging.INFO)
+    lib.logger.propagate = False
+    try:
+        getattr(lib, stage)()
+        if stage == "prepare":
+            lib.logger.info("detection libs:")
+            for item in lib.set_detection_libs_to_include:
+                lib.logger.info(f'traf_lib_include("detection" "{item}")')
+
+            lib.logger.info("xstream libs:")
+            for item in lib.set_xstream_libs_to_include:
+                lib.logger.info(f'traf_lib_include("xstream" "{item}")')
+
+            lib.logger.critical("Unknown libs:")
+            for item in lib.set_libs_not_included:
+                lib.logger.info(f'traf_lib_include("unknown" "{item}")')
+        return True
+    except Exception:
+        lib.passed = False
+        lib.logger.exception(f"Failed {stage} {lib.lib_name}")
+        return False
+    finally:
+        lib.logger.removeHandler(handler)
+        handler.close()
 
 
 def main():
@@ -294,23 +422,61 @@ def main():
     name_of_libs_to_clean = Lib.list_names_detection_libs \
         if clean_which_lib == "detection" else Lib.list_names_xstream_libs
 
+    path_state_file = Lib.path_binary_dir / f"clean_header_includes_{clean_which_lib}.json"
+    path_log_dir = Lib.path_binary_dir / "clean_header_includes_logs"
+    state = _load_state(path_state_file) if skip_unchanged_libs else {}
+    if use_include_index:
+        Lib.include_index = IncludeIndex(
+            Lib.path_binary_dir / "include_index.json",
+            IncludeIndex.get_known_libs_digest(Lib.set_names_detection_libs | Lib.set_names_xstream_libs))
+
+    libs_to_process: List[Lib] = []
     for lib_name in name_of_libs_to_clean:
         lib = Lib(lib_name, clean_which_lib)
-        lib.process()
-
-        logging.info("detection libs:")
-        for item in lib.set_detection_libs_to_include:
-            logging.info(f'traf_lib_include("detection" "{item}")')
-
-        logging.info("xstream libs:")
-        for item in lib.set_xstream_libs_to_include:
-            logging.info(f'traf_lib_include("xstream" "{item}")')
-
-        logging.critical("Unknown libs:")
-        for item in lib.set_libs_not_included:
-            logging.info(f'traf_lib_include("unknown" "{item}")')
+        with instrumentation.timer("hash_sources"):
+            is_unchanged = state.get(lib_name) == lib.get_source_hash()
+        if is_unchanged:
+            logging.critical(f"Skipped unchanged {lib_name}")
+            instrumentation.count("libs_skipped")
+            continue
+        libs_to_process.append(lib)
+
+    # Split the job budget between the builds that actually run concurrently
+    num_concurrent_libs = max(1, min(max_parallel_libs, len(libs_to_process)))
+    for lib in libs_to_process:
+        lib.jobs = max(1, total_jobs // num_concurrent_libs)
+
+    with ThreadPoolExecutor(max_workers=max_parallel_libs) as executor:
+        # A lib rewrites its own headers while the libs including them would compile against them: all the
+        # includes are rewritten before the first build starts
+        prepared = list(executor.map(lambda lib: _process_lib(lib, path_log_dir, "prepare"), libs_to_process))
+        futures = [executor.submit(_process_lib, lib, path_log_dir, "make")
+                   for lib, is_prepared in zip(libs_to_process, prepared) if is_prepared]
+        for future in futures:
+            future.result()
+        for lib in libs_to_process:
+            instrumentation.count("libs_passed" if lib.passed else "libs_failed")
+            logging.critical(f"{'Passed' if lib.passed else 'Failed'} {lib.lib_name} in {sum(lib.timings.values()):.2f} s, "
+                             f"log in {path_log_dir / (lib.lib_name + '.log')}")
+            # The hash is taken after processing since the include cleaning rewrites the sources
+            if lib.passed and not dry_run:
+                state[lib.lib_name] = lib.get_source_hash()
+                path_state_file.parent.mkdir(parents=True, exist_ok=True)
+                path_state_file.write_text(json.dumps(state, indent=2, sort_keys=True))
+
+    if Lib.include_index is not None and not dry_run:
+        with instrumentation.timer("save_include_index"):
+            Lib.include_index.remove_missing_files()
+            Lib.include_index.save()
+            known_libs = Lib.set_names_detection_libs | Lib.set_names_xstream_libs
+            Lib.include_index.export_graph(Lib.path_binary_dir / "include_graph.json", known_libs)
+        logging.critical(f"Include index: {Lib.include_index.num_parsed} files parsed, "
+                         f"{Lib.include_index.num_reused} files reused")
+        instrumentation.count("include_index_parsed", Lib.include_index.num_parsed)
+        instrumentation.count("include_index_reused", Lib.include_index.num_reused)
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.CRITICAL, format='%(message)s')
-    main()
+    with instrumentation.session("clean_header_includes"):
+        main()
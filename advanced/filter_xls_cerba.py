@@ -1,32 +1,213 @@
-from longest_common_substring import get_longest_common_substring
+import instrumentation
+from longest_common_substring import get_best_match_lengths
 
-import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+import hashlib
+import json
+import os
+from pathlib import Path
 import pandas as pd
-import re
+import shutil
+from typing import Dict, List, Optional
+
+cache_dir: Optional[str] = None  # e.g. ".cerba_cache" to reuse the preprocessed spreadsheets between runs
+report_dir: Optional[str] = None  # e.g. "cerba_report" to also write the discrepancies to files
+report_format = "csv"  # or "jsonl", "parquet"
 
 
 class TestData:
-    def __init__(self, xlsx_file: str):
-        self.data: pd.DataFrame = pd.read_excel(xlsx_file, index_col=None, header=0)
-        self._preprocess_data()
+    # Rows having any of these values in the column are dropped, subclasses extend the lists
+    excluded_values: Dict[str, List[str]] = {}
+    # Columns read by _preprocess_data on top of key, unique, print_col_names and excluded_values
+    preprocess_col_names: List[str] = []
+    cache_hits = 0
+    cache_misses = 0
+
+    def __init__(self, source_file: str, cache_dir: Optional[str] = None, refresh_cache: bool = False,
+                 bucket_dir: Optional[str] = None, num_buckets: int = 64, chunk_size: int = 100_000):
+        """
+        source_file is an .xlsx, .csv or .parquet export.
+        When cache_dir is given the preprocessed data is stored there (Parquet, or pickle when pyarrow
+        is missing) and reused as long as the path, mtime and size of source_file are unchanged.
+        refresh_cache forces a re-parse of source_file and overwrites the cached entry.
+        When bucket_dir is given the source (.csv or .parquet) is read chunk_size rows at a time and
+        partitioned on the key into num_buckets files, only one bucket is loaded at a time.
+        """
+        self.cache_hit = False
+        self.num_buckets = 0
+        if bucket_dir is not None:
+            self._partition(source_file, self._get_bucket_dir(source_file, bucket_dir, num_buckets), num_buckets,
+                            chunk_size)
+            self.load_bucket(0)
+            return
+
+        path_cache = self._get_cache_path(source_file, cache_dir) if cache_dir is not None else None
+        if path_cache is not None and not refresh_cache:
+            with instrumentation.timer("load"):
+                self.cache_hit = self._load_cache(path_cache)
+
+        if not self.cache_hit:
+            with instrumentation.timer("load"):
+                self.data: pd.DataFrame = self._read_source(source_file)
+            with instrumentation.timer("preprocess"):
+                self._preprocess_data()
+            if path_cache is not None:
+                with instrumentation.timer("store_cache"):
+                    self._store_cache(path_cache, source_file)
+
+        if path_cache is not None:
+            if self.cache_hit:
+                TestData.cache_hits += 1
+                instrumentation.count("cache_hits")
+            else:
+                TestData.cache_misses += 1
+                instrumentation.count("cache_misses")
+
+        with instrumentation.timer("index"):
+            self._index_data()
+        instrumentation.count("rows", len(self.data))
+
+    def _read_source(self, source_file: str) -> pd.DataFrame:
+        col_names = self._get_required_col_names()
+        suffix = Path(source_file).suffix
+        if suffix == ".csv":
+            return pd.read_csv(source_file, usecols=col_names)
+        if suffix == ".parquet":
+            return pd.read_parquet(source_file, columns=col_names)
+        return pd.read_excel(source_file, index_col=None, header=0, usecols=col_names)
+
+    def _iter_source_chunks(self, source_file: str, chunk_size: int):
+        col_names = self._get_required_col_names()
+        suffix = Path(source_file).suffix
+        if suffix == ".csv":
+            yield from pd.read_csv(source_file, usecols=col_names, chunksize=chunk_size)
+        elif suffix == ".parquet":
+            import pyarrow.parquet as pq
+            offset = 0
+            for batch in pq.ParquetFile(source_file).iter_batches(batch_size=chunk_size, columns=col_names):
+                chunk = batch.to_pandas()
+                # Row positions as index, same as the frame read in one go
+                chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+                offset += len(chunk)
+                yield chunk
+        else:
+            raise ValueError(f"Cannot stream {source_file}, convert it to .csv or .parquet first")
+
+    def _get_bucket_dir(self, source_file: str, bucket_dir: str, num_buckets: int) -> Path:
+        """Buckets are keyed on the source path, so that both sides of a comparison never share them"""
+        path_source = Path(source_file).resolve()
+        digest = hashlib.sha1(f"{path_source}|{num_buckets}".encode()).hexdigest()[:16]
+        return Path(bucket_dir) / f"{type(self).__name__}_{path_source.stem}_{digest}"
+
+    @instrumentation.timer("partition")
+    def _partition(self, source_file: str, path_bucket_dir: Path, num_buckets: int, chunk_size: int):
+        """Preprocesses the source chunk by chunk and appends every chunk to per-key hash buckets"""
+        shutil.rmtree(path_bucket_dir, ignore_errors=True)
+        path_bucket_dir.mkdir(parents=True)
+        self.path_bucket_dir = path_bucket_dir
+        self.num_buckets = num_buckets
+        self.data = pd.DataFrame(columns=self._get_required_col_names())
+        for chunk_number, chunk in enumerate(self._iter_source_chunks(source_file, chunk_size)):
+            self.data = chunk
+            self._preprocess_data()
+            # Stable across processes and runs, unlike hash()
+            buckets = pd.util.hash_pandas_object(self.data[self.key], index=False).values % num_buckets
+            for bucket, rows in self.data.groupby(buckets):
+                rows.to_pickle(path_bucket_dir / f"{bucket:05d}_{chunk_number:07d}.pkl")
+        self.empty_data = self.data.iloc[0:0]
+
+    @instrumentation.timer("load_bucket")
+    def load_bucket(self, bucket: int):
+        """Replaces data with the rows of one bucket"""
+        parts = [pd.read_pickle(path_part) for path_part in sorted(self.path_bucket_dir.glob(f"{bucket:05d}_*.pkl"))]
+        self.data = pd.concat(parts) if parts else self.empty_data
+        self._index_data()
+
+    def _get_required_col_names(self) -> List[str]:
+        col_names = [self.key, self.unique] + self.print_col_names + list(self.excluded_values) + \
+            self.preprocess_col_names
+        return list(dict.fromkeys(col_names))
+
+    def _get_cache_path(self, source_file: str, cache_dir: str) -> Path:
+        """Cache entries are keyed on the source path, mtime and size, the columns read and the exclusions"""
+        path_source = Path(source_file).resolve()
+        stat = path_source.stat()
+        cache_key = f"{path_source}|{stat.st_mtime_ns}|{stat.st_size}|{self._get_required_col_names()}|" \
+                    f"{sorted(self.excluded_values.items())}"
+        digest = hashlib.sha1(cache_key.encode()).hexdigest()[:16]
+        path_cache_dir = Path(cache_dir)
+        path_cache_dir.mkdir(parents=True, exist_ok=True)
+        return path_cache_dir / f"{type(self).__name__}_{path_source.stem}_{digest}"
+
+    def _load_cache(self, path_cache: Path) -> bool:
+        if path_cache.with_suffix(".parquet").exists():
+            self.data = pd.read_parquet(path_cache.with_suffix(".parquet"))
+            return True
+        if path_cache.with_suffix(".pkl").exists():
+            self.data = pd.read_pickle(path_cache.with_suffix(".pkl"))
+            return True
+        return False
+
+    def _store_cache(self, path_cache: Path, source_file: str):
+        # Drop the previous entry of the same source, e.g. from before the spreadsheet was updated. The
+        # entry of every source is recorded in an index, entry names alone cannot tell sources apart.
+        path_index = path_cache.parent / "cache_index.json"
+        index = json.loads(path_index.read_text()) if path_index.exists() else {}
+        source_key = f"{type(self).__name__}|{Path(source_file).resolve()}"
+        previous_name = index.get(source_key)
+        if previous_name is not None and previous_name != path_cache.name:
+            for suffix in (".parquet", ".pkl"):
+                (path_cache.parent / previous_name).with_suffix(suffix).unlink(missing_ok=True)
+        index[source_key] = path_cache.name
+        path_index_tmp = path_index.with_name(f".{path_index.name}.{os.getpid()}.tmp")
+        path_index_tmp.write_text(json.dumps(index, indent=2, sort_keys=True))
+        os.replace(path_index_tmp, path_index)
+        try:
+            self.data.to_parquet(path_cache.with_suffix(".parquet"))
+        except (ImportError, ValueError, TypeError):
+            # pyarrow is missing or cannot represent a mixed type column
+            path_cache.with_suffix(".parquet").unlink(missing_ok=True)
+            self.data.to_pickle(path_cache.with_suffix(".pkl"))
+
+    @classmethod
+    def clear_cache(cls, cache_dir: str) -> int:
+        """Removes the cached entries of this class (of all classes when called on TestData)"""
+        pattern = "*" if cls is TestData else f"{cls.__name__}_*"
+        removed = 0
+        for path_cache in Path(cache_dir).glob(pattern):
+            if path_cache.suffix in (".parquet", ".pkl"):
+                path_cache.unlink()
+                removed += 1
+        return removed
+
+    def _preprocess_data(self):
+        if not self.excluded_values:
+            return
+        condition = pd.Series(True, index=self.data.index)
+        for col_name, values in self.excluded_values.items():
+            condition &= ~self.data[col_name].isin(values)
+        self.data = self.data.loc[condition]
+
+    def _index_data(self):
         self.num_tests = self.data.shape[0]
         self.num_columns = self.data.shape[1]
         self.column_names = self.data.columns
-        self.groups = self.data.groupby(self.key).groups
-
-    def _preprocess_data(self):
-        pass
+        grouped = self.data.groupby(self.key)
+        self.groups = grouped.groups
+        # Row positions per key, so that a lookup costs O(group size) instead of a scan of the whole frame
+        self.group_indices = grouped.indices
 
     def get_rows_by_req_nr(self, value):
-        condition = self.data[self.key] == value
-        return self.data.loc[condition]
+        positions = self.group_indices.get(value, [])
+        return self.data.iloc[positions]
 
     def print_rows_by_req_nr(self, value):
-        pd.set_option('display.width', None)  # Display large column text as well
-        print(self.get_rows_by_req_nr(value)[self.print_col_names])
+        print(self.get_rows_by_req_nr(value)[self.print_col_names].to_string())  # Display large column text as well
 
     def print_stats(self):
-        print(f"{type(self).__name__}: Tests = {self.num_tests}, Columns = {self.num_columns}")
+        print(f"{type(self).__name__}: Tests = {self.num_tests}, Columns = {self.num_columns}, "
+              f"Cache hit = {self.cache_hit}")
         print(f"Column names: {self.column_names}")
         print(f"Groups: {self.groups}")
         print("\n")
@@ -36,93 +217,181 @@ class TestData:
 
 
 class TrovaTestData(TestData):
-    def __init__(self):
-        xlsx_file = "Trova_test_result_18-11-2022.xlsx"
+    excluded_values = {
+        'Test result': ['N R', 'N D', 'Pending', 'Sample not yet received'],
+        'Continent': ['Asia', 'North America'],
+    }
+
+    def __init__(self, source_file: str = "Trova_test_result_18-11-2022.xlsx", **kwargs):
         self.key = 'Requisition Nr'
         self.unique = 'Test'
         self.print_col_names = [self.key, self.unique, 'Visit']
-        super().__init__(xlsx_file)
-
-    def _preprocess_data(self):
-        super()._preprocess_data()
-        condition = (self.data['Test result'] != 'N R') & \
-                    (self.data['Test result'] != 'N D') & \
-                    (self.data['Test result'] != 'Pending') & \
-                    (self.data['Test result'] != 'Sample not yet received') & \
-                    (self.data['Continent'] != 'Asia') & \
-                    (self.data['Continent'] != 'North America')
-        self.data = self.data[condition]
+        super().__init__(source_file, **kwargs)
 
 
 class RealTestData(TestData):
-    def __init__(self):
-        xlsx_file = "REAL_Tests_EU.xlsx"
+    excluded_values = {
+        'VISITPANEL': ['VISIT'],
+    }
+
+    def __init__(self, source_file: str = "REAL_Tests_EU.xlsx", **kwargs):
         self.key = 'BARCNBR'
         self.unique = 'VISITPANEL_TEST'
         self.print_col_names = [self.key, self.unique, 'VISIT']
-        super().__init__(xlsx_file)
+        super().__init__(source_file, **kwargs)
 
     def _preprocess_data(self):
         super()._preprocess_data()
+        # Drop the barcode suffix starting at the first '-', numeric barcodes are read as numbers by Excel
+        barcodes = self.data[self.key]
+        barcodes = barcodes.where(barcodes.isna(), barcodes.astype(str))
+        self.data = self.data.assign(**{self.key: barcodes.str.split('-', n=1).str[0]})
 
-        def clean_barc_nr(barc_nr):
-            if re.search('-.*', barc_nr):
-                pos = re.search('-.*', barc_nr).start()
-                return barc_nr[:pos]
 
-            else:
-                return barc_nr
+def _find_missing_tests(task):
+    """
+    Worker for one requisition group, returns the index labels of reference tests without a match
+    and, when instrumentation is on, what the task recorded, which a pool worker cannot record in the parent
+    """
+    ref_index, ref_values, imported_values, min_match_length = task
+    previous = instrumentation.get_summary() if instrumentation.enabled else None
+    match_lengths = get_best_match_lengths(ref_values, imported_values, threshold=min_match_length)
+    recorded = instrumentation.get_summary_since(previous) if previous is not None else None
+    return list(ref_index[match_lengths < min_match_length]), recorded
+
+
+class CompareResult:
+    """
+    Discrepancies found by compare(), each backed by a DataFrame of print_col_names indexed by source row:
+    requisitions only in the reference data, reference tests without a match in a common requisition
+    and requisitions only in the imported data.
+    """
+    section_names = ('missing_requisitions', 'missing_tests', 'extra_requisitions')
+
+    def __init__(self, missing_requisitions: pd.DataFrame, missing_tests: pd.DataFrame,
+                 extra_requisitions: pd.DataFrame, ref_key: str, imported_key: str):
+        self.missing_requisitions = missing_requisitions.sort_index()
+        self.missing_tests = missing_tests.sort_index()
+        self.extra_requisitions = extra_requisitions.sort_index()
+        self.ref_key = ref_key
+        self.imported_key = imported_key
+
+    @classmethod
+    def concat(cls, results: List['CompareResult']) -> 'CompareResult':
+        return cls(*(pd.concat([getattr(result, name) for result in results]) for name in cls.section_names),
+                   results[0].ref_key, results[0].imported_key)
 
-        self.data[self.key] = self.data[self.key].apply(clean_barc_nr)
+    def get_missing_requisition_nrs(self) -> List:
+        return list(self.missing_requisitions[self.ref_key].unique())
 
-        condition = (self.data['VISITPANEL'] != 'VISIT')
-        self.data = self.data[condition]
+    def get_extra_requisition_nrs(self) -> List:
+        return list(self.extra_requisitions[self.imported_key].unique())
 
+    def write(self, path_dir: str, file_format: str = "csv"):
+        """Writes one csv, jsonl or parquet file per section, the source row becomes the `row` column"""
+        writers = {
+            "csv": lambda frame, path: frame.to_csv(path, index=False),
+            "jsonl": lambda frame, path: frame.to_json(path, orient='records', lines=True),
+            "parquet": lambda frame, path: frame.to_parquet(path, index=False),
+        }
+        if file_format not in writers:
+            raise ValueError(f"Unknown report format {file_format}, expected one of {list(writers)}")
+        Path(path_dir).mkdir(parents=True, exist_ok=True)
+        for name in self.section_names:
+            frame = getattr(self, name).rename_axis('row').reset_index()
+            writers[file_format](frame, Path(path_dir) / f"{name}.{file_format}")
 
-def compare(ref_data: TrovaTestData, imported_data: RealTestData):
+    def render(self) -> str:
+        missing_requisition_nrs = self.get_missing_requisition_nrs()
+        extra_requisition_nrs = self.get_extra_requisition_nrs()
+        num_incomplete = self.missing_tests[self.ref_key].nunique()
+        return "\n\n".join([
+            f"Requisition nr in reference but not in imported = {len(missing_requisition_nrs)} {missing_requisition_nrs}",
+            self.missing_requisitions.to_string(),
+            f"Requisition nr found but some tests missing = {num_incomplete}",
+            self.missing_tests.to_string(),
+            f"Requisition nr in imported but not in reference = {len(extra_requisition_nrs)} {extra_requisition_nrs}",
+            self.extra_requisitions.to_string(),
+        ])
+
+    def print_report(self):
+        print(self.render())
+
+
+@instrumentation.timer("match")
+def _reconcile(ref_data: TestData, imported_data: TestData, min_match_length: int,
+               executor: Optional[ProcessPoolExecutor] = None, chunk_size: int = 16) -> CompareResult:
     ref_set = set(ref_data.groups.keys())
     imported_set = set(imported_data.groups.keys())
     in_ref_but_not_imported = ref_set.difference(imported_set)
     in_imported_but_not_ref = imported_set.difference(ref_set)
 
-    print(f"\n\nRequisition nr in reference but not in imported = {len(in_ref_but_not_imported)}", in_ref_but_not_imported)
-    for test in in_ref_but_not_imported:
-        ref_data.print_rows_by_req_nr(test)
+    # Match column `Test` in reference data with column `VISITPANEL_TEST` in imported data.
+    # Only these two columns are shipped to the workers, never the whole DataFrames.
+    def tasks():
+        for req_nr in ref_set.intersection(imported_set):
+            unique_column_ref_tests = ref_data.get_rows_by_req_nr(req_nr)[ref_data.unique]
+            unique_column_imported_tests = imported_data.get_rows_by_req_nr(req_nr)[imported_data.unique]
+            yield (unique_column_ref_tests.index.values, unique_column_ref_tests.values,
+                   unique_column_imported_tests.values, min_match_length)
+
+    if executor is not None:
+        all_not_found_tests = executor.map(_find_missing_tests, tasks(), chunksize=chunk_size)
+    else:
+        all_not_found_tests = map(_find_missing_tests, tasks())
+    not_found_tests = []
+    for labels, recorded in all_not_found_tests:
+        not_found_tests.extend(labels)
+        if executor is not None and recorded is not None:
+            instrumentation.merge(recorded)
 
-    # Now check all matches
-    for req_nr in ref_set.intersection(imported_set):
-        ref_tests = ref_data.get_rows_by_req_nr(req_nr)
-        imported_tests = imported_data.get_rows_by_req_nr(req_nr)
+    return CompareResult(
+        ref_data.data.loc[ref_data.data[ref_data.key].isin(in_ref_but_not_imported), ref_data.print_col_names],
+        ref_data.data.loc[not_found_tests, ref_data.print_col_names],
+        imported_data.data.loc[imported_data.data[imported_data.key].isin(in_imported_but_not_ref),
+                               imported_data.print_col_names],
+        ref_data.key, imported_data.key)
 
-        # Match column `Test` in reference data with column `VISITPANEL_TEST` in imported data
-        if True:  # len(ref_tests) != len(imported_tests):
-            unique_column_ref_tests = ref_tests[ref_data.unique]
-            unique_column_imported_tests = imported_tests[imported_data.unique]
 
-            # print(f"\n\nTests in reference = {len(ref_tests)}")
-            # ref_data.print_rows_by_req_nr(req_nr)
-            # print(f"\n\nTests in imported = {len(imported_tests)}")
-            # imported_data.print_rows_by_req_nr(req_nr)
+def compare(ref_data: TrovaTestData, imported_data: RealTestData, min_match_length: int = 8,
+            workers: int = 1, chunk_size: int = 16) -> CompareResult:
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return _reconcile(ref_data, imported_data, min_match_length, executor, chunk_size)
+    return _reconcile(ref_data, imported_data, min_match_length)
 
-            not_found_tests = []
-            for key1, value1 in unique_column_ref_tests.items():
-                match_lengths = [get_longest_common_substring(value1, value).pop() for value in unique_column_imported_tests.values]
-                match_lengths = np.sort(match_lengths)
-                if len(match_lengths[-1]) < 8:
-                    not_found_tests.append(key1)
 
-            if not_found_tests:
-                print(f"\n\nRequisition nr found but some tests missing")
-                print(f"{ref_data.data.loc[not_found_tests][ref_data.print_col_names]}")
+def compare_streaming(ref_data: TrovaTestData, imported_data: RealTestData, min_match_length: int = 8,
+                      workers: int = 1, chunk_size: int = 16) -> CompareResult:
+    """
+    Same result as compare() for data partitioned with bucket_dir: the buckets are reconciled one
+    at a time, so only one bucket of each side is held in memory.
+    """
+    for data in (ref_data, imported_data):
+        if data.num_buckets == 0:
+            raise ValueError(f"{type(data).__name__} is not partitioned, load it with bucket_dir or use compare()")
+    if ref_data.num_buckets != imported_data.num_buckets:
+        raise ValueError(f"Bucket count mismatch: {ref_data.num_buckets} != {imported_data.num_buckets}")
 
-    print(f"\n\nRequisition nr in imported but not in reference {len(in_imported_but_not_ref)}", in_imported_but_not_ref)
-    for test in in_imported_but_not_ref:
-        imported_data.print_rows_by_req_nr(test)
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) if workers > 1 else nullcontext() as executor:
+        for bucket in range(ref_data.num_buckets):
+            ref_data.load_bucket(bucket)
+            imported_data.load_bucket(bucket)
+            results.append(_reconcile(ref_data, imported_data, min_match_length, executor, chunk_size))
+    return CompareResult.concat(results)
 
 
 if __name__ == "__main__":
-    trova_test_data = TrovaTestData()
-    real_test_data = RealTestData()
-    trova_test_data.print_stats()
-    real_test_data.print_stats()
-    compare(trova_test_data, real_test_data)
+    with instrumentation.session("filter_xls_cerba"):
+        trova_test_data = TrovaTestData(cache_dir=cache_dir)
+        real_test_data = RealTestData(cache_dir=cache_dir)
+        trova_test_data.print_stats()
+        real_test_data.print_stats()
+        if cache_dir is not None:
+            print(f"Cache hits = {TestData.cache_hits}, misses = {TestData.cache_misses}")
+        compare_result = compare(trova_test_data, real_test_data, workers=os.cpu_count())
+        with instrumentation.timer("report"):
+            if report_dir is not None:
+                compare_result.write(report_dir, report_format)
+            compare_result.print_report()
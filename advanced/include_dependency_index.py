@@ -0,0 +1,139 @@
+from graphlib import TopologicalSorter
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import re
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+path_index_file = Path("/home/akadar/Git/elio2/qtcreator-build/include_index.json")
+
+
+class IncludeIndex:
+    """
+    Persistent index of source file -> (mtime, size, content hash, owning lib, referenced libs).
+    Referenced libs are the `lib` parts of `#include "lib/header.h"` lines. The header cleaning tool strips
+    that qualifier, so the (lib, header) pairs it stripped are kept with the entry as long as the file
+    still includes the header. When known_libs_digest is given, entries recorded with another digest
+    (i.e. another set of known libs) are not reused.
+    """
+    pattern = re.compile(r"#include \"(.*)/(.*)\"\n")
+
+    def __init__(self, path_file: Path, known_libs_digest: Optional[str] = None):
+        self.path_file = path_file
+        self.known_libs_digest = known_libs_digest
+        self.entries: Dict[str, dict] = {}
+        self.num_parsed = 0
+        self.num_reused = 0
+        self._lock = threading.Lock()
+        if path_file.exists():
+            self.entries = json.loads(path_file.read_text())
+
+    def save(self):
+        self.path_file.parent.mkdir(parents=True, exist_ok=True)
+        path_tmp = self.path_file.with_name(f".{self.path_file.name}.{os.getpid()}.tmp")
+        path_tmp.write_text(json.dumps(self.entries, indent=1, sort_keys=True))
+        os.replace(path_tmp, self.path_file)
+
+    @staticmethod
+    def get_known_libs_digest(known_libs: Iterable[str]) -> str:
+        return hashlib.sha1("\n".join(sorted(known_libs)).encode()).hexdigest()
+
+    def get_unchanged_entry(self, path_source_file: Path) -> Optional[dict]:
+        """Returns the entry when the file and the known libs are unchanged since it was recorded, else None"""
+        entry = self.entries.get(str(path_source_file))
+        if entry is None:
+            return None
+        if self.known_libs_digest is not None and entry.get("known_libs_digest") != self.known_libs_digest:
+            return None
+        stat = path_source_file.stat()
+        if entry["mtime_ns"] != stat.st_mtime_ns or entry["size"] != stat.st_size:
+            # Touched but maybe not modified
+            if hashlib.sha1(path_source_file.read_bytes()).hexdigest() != entry["sha1"]:
+                return None
+            entry["mtime_ns"], entry["size"] = stat.st_mtime_ns, stat.st_size
+        with self._lock:
+            self.num_reused += 1
+        return entry
+
+    def record(self, path_source_file: Path, owner: str, libs: Iterable[str], text: str,
+               stripped: Iterable[Tuple[str, str]] = ()):
+        """
+        Records the libs referenced by path_source_file, text being its current content. libs are the ones
+        parsed before any rewrite and stripped the (lib, header) pairs whose qualifier was just removed.
+        """
+        stat = path_source_file.stat()
+        previous_entry = self.entries.get(str(path_source_file), {})
+        # Pairs stripped by former runs only count while their unqualified include is still there
+        stripped_pairs = {tuple(pair) for pair in previous_entry.get("stripped", [])
+                          if f'#include "{pair[1]}"\n' in text}
+        stripped_pairs.update(stripped)
+        with self._lock:
+            self.num_parsed += 1
+            self.entries[str(path_source_file)] = {
+                "mtime_ns": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "sha1": hashlib.sha1(text.encode()).hexdigest(),
+                "owner": owner,
+                "libs": sorted(set(libs).union(lib for lib, _ in stripped_pairs)),
+                "stripped": sorted([lib, header] for lib, header in stripped_pairs),
+                "known_libs_digest": self.known_libs_digest,
+            }
+
+    def update(self, path_source_file: Path, owner: str) -> dict:
+        """Re-parses path_source_file only when it changed and returns its entry"""
+        entry = self.get_unchanged_entry(path_source_file)
+        if entry is None:
+            text = path_source_file.read_text()
+            self.record(path_source_file, owner, (match.group(1) for match in self.pattern.finditer(text)), text)
+            entry = self.entries[str(path_source_file)]
+        return entry
+
+    def remove_missing_files(self) -> int:
+        with self._lock:
+            missing = [path for path in self.entries if not Path(path).exists()]
+            for path in missing:
+                del self.entries[path]
+        return len(missing)
+
+    def get_dependencies(self, lib_name: str) -> Set[str]:
+        """Libs included by the files of lib_name"""
+        return {lib for entry in self.entries.values() if entry["owner"] == lib_name
+                for lib in entry["libs"] if lib != lib_name}
+
+    def get_dependents(self, lib_name: str) -> Set[str]:
+        """Libs having a file that includes lib_name"""
+        return {entry["owner"] for entry in self.entries.values()
+                if lib_name in entry["libs"] and entry["owner"] != lib_name}
+
+    def get_graph(self, known_libs: Optional[Set[str]] = None) -> Dict[str, List[str]]:
+        """Lib -> sorted libs it depends on, optionally restricted to known_libs"""
+        graph: Dict[str, Set[str]] = {}
+        for entry in self.entries.values():
+            owner = entry["owner"]
+            if known_libs is not None and owner not in known_libs:
+                continue
+            dependencies = graph.setdefault(owner, set())
+            for lib in entry["libs"]:
+                if lib != owner and (known_libs is None or lib in known_libs):
+                    dependencies.add(lib)
+        return {owner: sorted(dependencies) for owner, dependencies in sorted(graph.items())}
+
+    def get_build_order(self, known_libs: Optional[Set[str]] = None) -> List[str]:
+        """Libs ordered so that every lib comes after its dependencies, raises graphlib.CycleError on cycles"""
+        return list(TopologicalSorter(self.get_graph(known_libs)).static_order())
+
+    def export_graph(self, path_export_file: Path, known_libs: Optional[Set[str]] = None):
+        path_export_file.write_text(json.dumps(self.get_graph(known_libs), indent=2))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    include_index = IncludeIndex(path_index_file)
+    dependency_graph = include_index.get_graph()
+    for lib_name, dependencies in dependency_graph.items():
+        logging.info(f"{lib_name} depends on: {', '.join(dependencies)}")
+        logging.info(f"{lib_name} is included by: {', '.join(sorted(include_index.get_dependents(lib_name)))}")
+    logging.info(f"Build order: {', '.join(include_index.get_build_order())}")
@@ -1,6 +1,10 @@
+import instrumentation
+
+import importlib
 import inspect
 import json
-import sys
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, Type, Union
 
 
 data = {
@@ -14,7 +18,133 @@ data = {
    }
 }
 
-
+pipeline_configs_path: Optional[str] = None  # directory of *.json or a *.jsonl file, one pipeline per file or line
+
+
+class PipelineConfigError(ValueError):
+    def __init__(self, errors: List[str]):
+        super().__init__("\n".join(errors))
+        self.errors = errors
+
+
+class ParameterPlan(NamedTuple):
+    name: str
+    default: object  # inspect.Parameter.empty when the parameter is required
+    coercer: Callable
+    keyword_only: bool
+
+
+class AugmentationRegistry:
+    """
+    Augmentation classes by name, with a construction plan built once per class from its signature.
+    Instantiating from a config then needs no reflection and leaves the config dict untouched.
+    """
+    def __init__(self):
+        self.classes: Dict[str, Type] = {}
+        self._lazy_paths: Dict[str, str] = {}
+        self._plans: Dict[Type, Tuple[ParameterPlan, ...]] = {}
+        self._accepts_any_keyword: Dict[Type, bool] = {}
+
+    def register(self, class_type: Type, name: str = None) -> Type:
+        """Registers class_type, usable as a class decorator"""
+        self.classes[name or class_type.__name__] = class_type
+        return class_type
+
+    def register_lazy(self, name: str, dotted_path: str):
+        """Registers a class by dotted path, its module is imported on first use only"""
+        self._lazy_paths[name] = dotted_path
+
+    def resolve(self, name: str) -> Type:
+        """Registered class by name, a name containing a dot is imported as a dotted path"""
+        class_type = self.classes.get(name)
+        if class_type is None:
+            module_name, _, attribute = self._lazy_paths.get(name, name).rpartition('.')
+            if not module_name:
+                raise KeyError(f"Unknown augmentation class {name}")
+            class_type = self.classes[name] = getattr(importlib.import_module(module_name), attribute)
+        return class_type
+
+    def get_plan(self, class_type: Type) -> Tuple[ParameterPlan, ...]:
+        plan = self._plans.get(class_type)
+        if plan is None:
+            plan = []
+            parameters = inspect.signature(class_type.__init__).parameters.values()
+            for param in parameters:
+                if param.name == 'self' or param.kind in (param.VAR_POSITIONAL, param.VAR_KEYWORD):
+                    continue
+                # Only plain types cast the value, e.g. not Optional[int] nor a missing annotation
+                if param.annotation is param.empty or not isinstance(param.annotation, type):
+                    coercer = _identity
+                else:
+                    coercer = param.annotation
+                plan.append(ParameterPlan(param.name, param.default, coercer, param.kind == param.KEYWORD_ONLY))
+            self._accepts_any_keyword[class_type] = any(param.kind == param.VAR_KEYWORD for param in parameters)
+            plan = self._plans[class_type] = tuple(plan)
+        return plan
+
+    def validate(self, class_name: str, class_parameters: dict) -> List[str]:
+        """All the errors create() would run into, without constructing anything"""
+        try:
+            class_type = self.resolve(class_name)
+        except (KeyError, ImportError, AttributeError) as error:
+            return [f"{class_name}: cannot import: {error}"]
+        if not isinstance(class_parameters, dict):
+            return [f"{class_name}: parameters must be an object, got {class_parameters!r}"]
+        plan = self.get_plan(class_type)
+        errors = []
+        if not self._accepts_any_keyword[class_type]:
+            known_names = {param.name for param in plan}
+            errors.extend(f"{class_name}: unknown parameter {name}" for name in class_parameters if name not in known_names)
+        for name, default, coercer, _ in plan:
+            if name not in class_parameters:
+                if default is inspect.Parameter.empty:
+                    errors.append(f"{class_name}: missing parameter {name} without default")
+                continue
+            value = class_parameters[name]
+            if _is_type_mismatch(default, value):
+                errors.append(f"{class_name}: {name} = {value!r} does not match the default {default!r}")
+                continue
+            try:
+                coercer(value)
+            except (TypeError, ValueError) as error:
+                errors.append(f"{class_name}: {name} = {value!r} cannot be converted: {error}")
+        return errors
+
+    def create(self, class_type: Union[str, Type], class_parameters: dict):
+        if isinstance(class_type, str):
+            class_type = self.resolve(class_type)
+        args = []
+        kwargs = {}
+        for name, default, coercer, keyword_only in self.get_plan(class_type):
+            if name in class_parameters:
+                value = class_parameters[name]
+                if _is_type_mismatch(default, value):
+                    raise TypeError(f"{class_type.__name__}.{name} = {value!r} does not match the default {default!r}")
+            elif default is inspect.Parameter.empty:
+                raise KeyError(f"{class_type.__name__}.{name} not present in json and also there is no default available.")
+            else:
+                value = default
+            if keyword_only:
+                kwargs[name] = coercer(value)
+            else:
+                args.append(coercer(value))
+        return class_type(*args, **kwargs)
+
+
+def _identity(value):
+    return value
+
+
+def _is_type_mismatch(default, value) -> bool:
+    return default is not inspect.Parameter.empty and default is not None and bool(value) \
+        and not isinstance(default, type(value))
+
+
+augmentation_registry = AugmentationRegistry()
+augmentation_registry.register_lazy("BatchHorizontalFlip", "batch_modifiers.BatchHorizontalFlip")
+
+
+@augmentation_registry.register
 class RandomInvert(object):
     def __init__(self, chance: float = 0.5):
         self.chance = max(0.0, min(1.0, chance))
@@ -23,6 +153,7 @@ class RandomInvert(object):
         print("self.chance: ", self.chance)
 
 
+@augmentation_registry.register
 class RandomStretch(object):
     def __init__(self, factor: int, chance: float = 0.5, max_stretch_percent: int = 50):
         self.factor = factor
@@ -43,33 +174,62 @@ def read_json() -> dict:
 
 
 def get_augmentation_object(class_type, class_parameters: dict):
-    sig = inspect.signature(class_type.__init__)
-    # sig_bind = sig.bind(class_parameters)
-    attributes = []
-    for param in sig.parameters.values():
-        if param.name == 'self':
-            continue
-
-        if param.default is not inspect.Parameter.empty and class_parameters.get(param.name):
-            assert isinstance(param.default, type(class_parameters[param.name]))
-
-        new_param = class_parameters.setdefault(param.name, param.default)
-        if new_param is inspect.Parameter.empty:
-            print('Parameter not present in json and also there is no default available.')
-            raise KeyError
-        attributes.append(param.annotation(new_param))
-
-    return class_type(*attributes)
+    return augmentation_registry.create(class_type, class_parameters)
+
+
+def read_pipeline_configs(path: str) -> Tuple[Dict[str, dict], List[str]]:
+    """Pipeline configs by name from a directory of *.json files or from a JSON lines file, and parse errors"""
+    path = Path(path)
+    if path.is_dir():
+        sources = [(path_file.name, path_file.read_text()) for path_file in sorted(path.glob("*.json"))]
+    else:
+        with open(path) as fp:
+            sources = [(f"{path.name}:{line_number}", line) for line_number, line in enumerate(fp, 1) if line.strip()]
+
+    configs = {}
+    errors = []
+    for name, text in sources:
+        try:
+            configs[name] = json.loads(text)
+        except json.JSONDecodeError as error:
+            errors.append(f"{name}: invalid json: {error}")
+    return configs, errors
+
+
+def load_pipelines(path: str, registry: AugmentationRegistry = augmentation_registry) -> Dict[str, list]:
+    """
+    Reads and validates all the pipeline configs at path before building any of them. Classes are imported
+    only when a config uses them. Raises PipelineConfigError listing every error found.
+    """
+    with instrumentation.timer("load"):
+        configs, errors = read_pipeline_configs(path)
+    instrumentation.count("pipelines", len(configs))
+    with instrumentation.timer("validate"):
+        for name, config in configs.items():
+            if not isinstance(config, dict):
+                errors.append(f"{name}: a pipeline must be an object of class name to parameters")
+                continue
+            for class_name, class_parameters in config.items():
+                errors.extend(f"{name}: {error}" for error in registry.validate(class_name, class_parameters))
+    if errors:
+        instrumentation.count("config_errors", len(errors))
+        raise PipelineConfigError(errors)
+
+    with instrumentation.timer("create"):
+        return {name: [registry.create(class_name, class_parameters)
+                       for class_name, class_parameters in config.items()]
+                for name, config in configs.items()}
 
 
 if __name__ == "__main__":
     # data = read_json()
 
-    classes = {}
-    for name, obj in inspect.getmembers(sys.modules[__name__]):
-        if inspect.isclass(obj):
-            classes[name] = obj
+    with instrumentation.session("inspect_change_class_parameters"):
+        if pipeline_configs_path is not None:
+            pipelines = load_pipelines(pipeline_configs_path)
+            print(f"Loaded {len(pipelines)} pipelines from {pipeline_configs_path}")
 
-    for key, value in data.items():
-        augmentation_object = get_augmentation_object(classes[key], value)
-        augmentation_object()
+        for key, value in data.items():
+            with instrumentation.timer("create"):
+                augmentation_object = augmentation_registry.create(key, value)
+            augmentation_object()
@@ -0,0 +1,181 @@
+import contextlib
+import cProfile
+import functools
+import json
+import os
+from pathlib import Path
+import threading
+import time
+import tracemalloc
+from typing import Dict, Optional
+
+# ADVANCED_INSTRUMENTATION=timing (or 1) records phase timings and counters, add profile for cProfile
+# and memory for tracemalloc, e.g. ADVANCED_INSTRUMENTATION=timing,profile,memory. Read at import time.
+options = {option.strip() for option in os.environ.get("ADVANCED_INSTRUMENTATION", "").lower().split(",")} \
+    - {"", "0"}
+enabled = bool(options)
+output_dir = os.environ.get("ADVANCED_INSTRUMENTATION_DIR", "instrumentation")
+
+
+class _Recorder:
+    """Phase timings and counters of the current session, updated from any thread"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases: Dict[str, Dict[str, float]] = {}
+        self.counters: Dict[str, int] = {}
+
+    def reset(self):
+        with self.lock:
+            self.phases = {}
+            self.counters = {}
+
+    def add_time(self, name: str, seconds: float, calls: int = 1):
+        with self.lock:
+            phase = self.phases.setdefault(name, {"calls": 0, "seconds": 0.0})
+            phase["calls"] += calls
+            phase["seconds"] += seconds
+
+    def count(self, name: str, value: int):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+
+_recorder = _Recorder()
+
+
+class _Timer:
+    """Adds the time spent in the with block, or in the decorated function, to the phase name"""
+    __slots__ = ("name", "totals", "start")
+
+    def __init__(self, name: str, totals: Optional[Dict[str, float]] = None):
+        self.name = name
+        self.totals = totals
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        if enabled:
+            _recorder.add_time(self.name, seconds)
+        if self.totals is not None:
+            self.totals[self.name] = self.totals.get(self.name, 0.0) + seconds
+        return False
+
+    def __call__(self, function):
+        name, totals = self.name, self.totals
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with _Timer(name, totals):
+                return function(*args, **kwargs)
+        return wrapper
+
+
+class _NullTimer:
+    """Timer when instrumentation is off: an empty with block, and decorated functions are left untouched"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def __call__(self, function):
+        return function
+
+
+_null_timer = _NullTimer()
+
+
+def timer(name: str, totals: Optional[Dict[str, float]] = None):
+    """
+    `with timer("load"):` or `@timer("load")`. The seconds are also added to totals[name] when given,
+    even with instrumentation off, for callers that report their own timings.
+    """
+    return _Timer(name, totals) if enabled or totals is not None else _null_timer
+
+
+def add_time(name: str, seconds: float):
+    """For phases that are already measured by the caller"""
+    if enabled:
+        _recorder.add_time(name, seconds)
+
+
+def count(name: str, value: int = 1):
+    if enabled:
+        _recorder.count(name, value)
+
+
+def get_summary() -> Dict[str, object]:
+    with _recorder.lock:
+        return {"phases": {name: dict(phase) for name, phase in _recorder.phases.items()},
+                "counters": dict(_recorder.counters)}
+
+
+def get_summary_since(previous: Dict[str, object]) -> Dict[str, object]:
+    """What was recorded after previous = get_summary(), e.g. by one task of a pool worker"""
+    summary = get_summary()
+    phases = {}
+    for name, phase in summary["phases"].items():
+        previous_phase = previous["phases"].get(name, {"calls": 0, "seconds": 0.0})
+        if phase["calls"] != previous_phase["calls"]:
+            phases[name] = {"calls": phase["calls"] - previous_phase["calls"],
+                            "seconds": phase["seconds"] - previous_phase["seconds"]}
+    counters = {name: value - previous["counters"].get(name, 0) for name, value in summary["counters"].items()
+                if value != previous["counters"].get(name, 0)}
+    return {"phases": phases, "counters": counters}
+
+
+def merge(summary: Dict[str, object]):
+    """
+    Adds a summary recorded in another process: the workers of a process pool record into their own
+    copy of this module, so a task returns get_summary_since() and the parent merges it into its session
+    """
+    if not enabled:
+        return
+    for name, phase in summary["phases"].items():
+        _recorder.add_time(name, phase["seconds"], phase["calls"])
+    for name, value in summary["counters"].items():
+        _recorder.count(name, value)
+
+
+@contextlib.contextmanager
+def session(name: str, path_dir: Optional[str] = None):
+    """
+    Instruments an entry point: the timings and counters recorded in the block are written to
+    <path_dir>/<name>.json, along with the cProfile stats (<name>.prof, main thread only) and the
+    tracemalloc peak when requested. Does nothing when instrumentation is off.
+    """
+    if not enabled:
+        yield
+        return
+    _recorder.reset()
+    profiler = cProfile.Profile() if "profile" in options else None
+    trace_memory = "memory" in options and not tracemalloc.is_tracing()
+    if trace_memory:
+        tracemalloc.start()
+    started = time.strftime("%Y-%m-%dT%H:%M:%S")
+    start = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        summary = {"name": name, "started": started, "total_seconds": time.perf_counter() - start}
+        summary.update(get_summary())
+        path_dir = Path(path_dir if path_dir is not None else output_dir)
+        path_dir.mkdir(parents=True, exist_ok=True)
+        if trace_memory:
+            current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            summary["memory"] = {"current_bytes": current_bytes, "peak_bytes": peak_bytes}
+        if profiler is not None:
+            profiler.dump_stats(path_dir / f"{name}.prof")
+            summary["profile"] = str(path_dir / f"{name}.prof")
+        (path_dir / f"{name}.json").write_text(json.dumps(summary, indent=2))
@@ -0,0 +1,94 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+from pathlib import Path
+import re
+import threading
+from typing import Callable, Iterable, List, Optional, Pattern, Tuple, Union
+
+Block = Tuple[int, int]  # first and last line number of a run of consecutive matching lines
+
+
+def _compile(pattern: Union[str, Pattern]) -> Pattern:
+    return re.compile(pattern) if isinstance(pattern, str) else pattern
+
+
+def write_text_atomic(path_file: Path, text: str):
+    """Write to a temporary file next to path_file and move it in place, readers never see a partial file"""
+    path_tmp = path_file.with_name(f".{path_file.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    path_tmp.write_text(text)
+    os.replace(path_tmp, path_file)
+
+
+def get_matching_line_numbers(lines: List[str], pattern: Union[str, Pattern]) -> List[int]:
+    search = _compile(pattern).search
+    return [index for index, line in enumerate(lines) if search(line)]
+
+
+def get_blocks(line_numbers: List[int]) -> List[Block]:
+    """Runs of consecutive line numbers, in a single pass"""
+    blocks: List[Block] = []
+    for line_number in line_numbers:
+        if blocks and line_number == blocks[-1][1] + 1:
+            blocks[-1] = (blocks[-1][0], line_number)
+        else:
+            blocks.append((line_number, line_number))
+    return blocks
+
+
+def get_largest_block(blocks: List[Block]) -> Optional[Block]:
+    """The first of the longest blocks, None when there is no block"""
+    return max(blocks, key=lambda block: block[1] - block[0], default=None)
+
+
+class LineBlockFile:
+    """Lines of a text file, edited in memory by blocks of matching lines and saved atomically"""
+    def __init__(self, path_file: Path):
+        self.path_file = path_file
+        with open(path_file, 'r') as fp:
+            self.lines: List[str] = fp.readlines()
+        self.is_changed = False
+
+    def get_blocks(self, pattern: Union[str, Pattern]) -> List[Block]:
+        return get_blocks(get_matching_line_numbers(self.lines, pattern))
+
+    def replace_block(self, block: Block, new_lines: List[str]):
+        begin, end = block
+        if self.lines[begin:end + 1] != new_lines:
+            self.lines[begin:end + 1] = new_lines
+            self.is_changed = True
+
+    def sort_blocks(self, pattern: Union[str, Pattern], reverse: bool = True):
+        """Sorts and de-duplicates every block of lines matching pattern"""
+        # Last block first, so that shrinking a block does not shift the ones still to be sorted
+        for block in reversed(self.get_blocks(pattern)):
+            self.replace_block(block, sorted(set(self.lines[block[0]:block[1] + 1]), reverse=reverse))
+
+    def merge_into_largest_block(self, pattern: Union[str, Pattern], new_lines: Iterable[str]) -> Optional[Block]:
+        """
+        Adds new_lines to the largest block of lines matching pattern, the block is kept sorted and
+        de-duplicated. Returns the block before the edit, None when no line matches.
+        """
+        block = get_largest_block(self.get_blocks(pattern))
+        if block is None:
+            return None
+        begin, end = block
+        self.replace_block(block, sorted(set(self.lines[begin:end + 1]).union(new_lines)))
+        return block
+
+    def save(self):
+        if self.is_changed:
+            write_text_atomic(self.path_file, "".join(self.lines))
+            self.is_changed = False
+
+
+def edit_files(path_files: Iterable[Path], edit: Callable[[LineBlockFile], None], workers: int = 8) -> List[bool]:
+    """Applies edit to every file on a thread pool and saves the changed ones, returns the changed flags"""
+    def edit_file(path_file: Path) -> bool:
+        line_block_file = LineBlockFile(path_file)
+        edit(line_block_file)
+        is_changed = line_block_file.is_changed
+        line_block_file.save()
+        return is_changed
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(edit_file, path_files))
@@ -1,3 +1,10 @@
+import instrumentation
+
+from typing import Iterable, Optional, Sequence, Tuple
+
+import numpy as np
+
+
 def get_longest_common_substring(str1, str2):
     m = len(str1)
     n = len(str2)
@@ -19,9 +26,151 @@ def get_longest_common_substring(str1, str2):
     return lcs_set
 
 
+def get_longest_common_substring_match(str1, str2) -> Tuple[int, int]:
+    """
+    Returns the length of the longest common substring and its end offset in str1,
+    such that str1[end - length:end] is the (first) longest match.
+    Only two rows of the DP table are kept, sized after the shorter string.
+    """
+    swapped = len(str2) > len(str1)
+    outer, inner = (str1, str2) if not swapped else (str2, str1)
+    n = len(inner)
+    previous = [0] * (n + 1)
+    current = [0] * (n + 1)
+    longest = 0
+    end = 0
+    for i, char in enumerate(outer):
+        for j in range(n):
+            if char == inner[j]:
+                c = previous[j] + 1
+                current[j + 1] = c
+                if c > longest:
+                    longest = c
+                    end = j + 1 if swapped else i + 1
+            else:
+                current[j + 1] = 0
+        previous, current = current, previous
+
+    return longest, end
+
+
+def get_longest_common_substring_length(str1, str2) -> int:
+    """Returns only the length of the longest common substring, no substrings are built"""
+    longest, _ = get_longest_common_substring_match(str1, str2)
+    return longest
+
+
+class SuffixAutomaton:
+    """
+    Suffix automaton of a single query string.
+    Built once in O(len(query)), then every candidate is scored in O(len(candidate)).
+    """
+    def __init__(self, query: str):
+        self.query = query
+        self.transitions = [{}]
+        self.links = [-1]
+        self.lengths = [0]
+        last = 0
+        for char in query:
+            last = self._extend(last, char)
+
+    def _extend(self, last: int, char: str) -> int:
+        transitions, links, lengths = self.transitions, self.links, self.lengths
+        current = len(lengths)
+        transitions.append({})
+        links.append(0)
+        lengths.append(lengths[last] + 1)
+        state = last
+        while state != -1 and char not in transitions[state]:
+            transitions[state][char] = current
+            state = links[state]
+        if state != -1:
+            target = transitions[state][char]
+            if lengths[state] + 1 == lengths[target]:
+                links[current] = target
+            else:
+                clone = len(lengths)
+                transitions.append(dict(transitions[target]))
+                links.append(links[target])
+                lengths.append(lengths[state] + 1)
+                while state != -1 and transitions[state].get(char) == target:
+                    transitions[state][char] = clone
+                    state = links[state]
+                links[target] = clone
+                links[current] = clone
+        return current
+
+    def longest_match(self, candidate: str, threshold: Optional[int] = None) -> int:
+        """
+        Returns the length of the longest common substring of the query and the candidate.
+        When threshold is given the scan stops as soon as a match of that length is found.
+        """
+        transitions, links, lengths = self.transitions, self.links, self.lengths
+        state = 0
+        length = 0
+        longest = 0
+        for char in candidate:
+            while state and char not in transitions[state]:
+                state = links[state]
+                length = lengths[state]
+            if char in transitions[state]:
+                state = transitions[state][char]
+                length += 1
+                if length > longest:
+                    longest = length
+                    if threshold is not None and longest >= threshold:
+                        break
+        return longest
+
+
+@instrumentation.timer("longest_common_substring")
+def get_longest_common_substring_lengths(query: str, candidates: Iterable[str],
+                                         threshold: Optional[int] = None) -> np.ndarray:
+    """
+    Scores one query against many candidates with a single suffix automaton.
+    Returns the longest common substring length per candidate, lengths are capped
+    at threshold when one is given.
+    """
+    instrumentation.count("automata_built")
+    automaton = SuffixAutomaton(query)
+    return np.fromiter((automaton.longest_match(candidate, threshold) for candidate in candidates),
+                       dtype=np.int64)
+
+
+@instrumentation.timer("longest_common_substring")
+def get_best_match_lengths(queries: Sequence[str], candidates: Sequence[str],
+                           threshold: Optional[int] = None) -> np.ndarray:
+    """
+    Scores two whole columns: for every query returns the best longest common substring
+    length over all candidates. When threshold is given a query stops at the first
+    candidate reaching it, so the reported length is only exact below the threshold.
+    """
+    instrumentation.count("automata_built", len(queries))
+    best_lengths = np.zeros(len(queries), dtype=np.int64)
+    for index, query in enumerate(queries):
+        automaton = SuffixAutomaton(query)
+        best = 0
+        for candidate in candidates:
+            best = max(best, automaton.longest_match(candidate, threshold))
+            if threshold is not None and best >= threshold:
+                break
+        best_lengths[index] = best
+    return best_lengths
+
+
 if __name__ == "__main__":
-    string1 = "An apple a day keeps the doctor away."
-    string2 = "Stay away from the doctor."
-    common_substrings = get_longest_common_substring(string1, string2)
-    for lcs in common_substrings:
-        print(lcs)
+    with instrumentation.session("longest_common_substring"):
+        string1 = "An apple a day keeps the doctor away."
+        string2 = "Stay away from the doctor."
+        common_substrings = get_longest_common_substring(string1, string2)
+        for lcs in common_substrings:
+            print(lcs)
+
+        length, end = get_longest_common_substring_match(string1, string2)
+        print(length, repr(string1[end - length:end]))
+        assert length == get_longest_common_substring_length(string2, string1)
+        assert length == len(next(iter(common_substrings)))
+
+        candidates = [string2, "apple pie", "no match here", ""]
+        print(get_longest_common_substring_lengths(string1, candidates))
+        print(get_best_match_lengths([string1, "xyz"], candidates, threshold=8))
@@ -0,0 +1,126 @@
+import contextlib
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+small_matrix_size = 16  # up to this number of columns einsum beats one BLAS call per matrix
+
+
+def _get_threadpool_limits():
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError as error:
+        raise ImportError("num_threads requires threadpoolctl, pip install threadpoolctl") from error
+    return threadpool_limits
+
+
+@contextlib.contextmanager
+def blas_threads(num_threads: Optional[int]):
+    """
+    Limits the threads of the BLAS library for the duration of the block, None leaves them unchanged.
+    Limiting them requires threadpoolctl: the environment variables of the BLAS libraries are only read
+    when they are loaded, so setting them here would not change anything.
+    """
+    if num_threads is None:
+        yield
+        return
+    with _get_threadpool_limits()(limits=num_threads, user_api='blas'):
+        yield
+
+
+def get_blas_dtype(dtype) -> np.dtype:
+    """
+    dtype the products run in: float32 and float64 go through BLAS, integers and anything else do not and are
+    computed as float64, which is exact as long as the products and their sums stay below 2**53
+    """
+    dtype = np.dtype(dtype)
+    return dtype if dtype in (np.float32, np.float64) else np.dtype(np.float64)
+
+
+def stack(arrays: Iterable, dtype=None, order: str = 'C') -> np.ndarray:
+    """Stacks arrays of the same shape into one contiguous (n, ...) array of a BLAS dtype"""
+    arrays = [np.asarray(array) for array in arrays]
+    dtype = get_blas_dtype(dtype if dtype is not None else np.result_type(*arrays))
+    stacked = np.empty((len(arrays),) + arrays[0].shape, dtype=dtype, order=order)
+    for index, array in enumerate(arrays):
+        stacked[index] = array
+    return stacked
+
+
+class BatchedProducts:
+    """
+    Batched matrix-vector and matrix-matrix products through np.matmul or np.einsum into output buffers
+    that are allocated once per shape and dtype and reused by the next calls of the same shape.
+    The returned arrays are these buffers, copy them to keep them across calls.
+    method 'auto' picks einsum for matrix-vector products of small matrices, where calling BLAS once per
+    matrix costs more than the product, and matmul otherwise.
+    """
+    def __init__(self, method: str = 'auto', num_threads: Optional[int] = None):
+        if method not in ('auto', 'matmul', 'einsum'):
+            raise ValueError(f"Unknown method {method}, expected auto, matmul or einsum")
+        if num_threads is not None:
+            _get_threadpool_limits()  # fail here rather than at the first product
+        self.method = method
+        self.num_threads = num_threads
+        self.buffers: Dict[Tuple[Tuple[int, ...], np.dtype], np.ndarray] = {}
+
+    def _get_buffer(self, shape: Tuple[int, ...], dtype: np.dtype) -> np.ndarray:
+        key = (shape, dtype)
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            buffer = self.buffers[key] = np.empty(shape, dtype)
+        return buffer
+
+    @staticmethod
+    def _as_blas(array) -> np.ndarray:
+        array = np.asarray(array)
+        return array.astype(get_blas_dtype(array.dtype), copy=False)
+
+    def matmat(self, matrices, others) -> np.ndarray:
+        """matrices (n, m, k) @ others (n, k, p) -> (n, m, p), either side can be a single matrix"""
+        matrices, others = self._as_blas(matrices), self._as_blas(others)
+        dtype = np.result_type(matrices, others)
+        shape = np.broadcast_shapes(matrices.shape[:-2], others.shape[:-2]) \
+            + (matrices.shape[-2], others.shape[-1])
+        out = self._get_buffer(shape, dtype)
+        with blas_threads(self.num_threads):
+            if self.method == 'einsum':
+                np.einsum('...mk,...kp->...mp', matrices, others, out=out)
+            else:
+                np.matmul(matrices, others, out=out)
+        return out
+
+    def matvec(self, matrices, vectors) -> np.ndarray:
+        """matrices (n, m, k) applied to vectors (n, k) -> (n, m), or one matrix (m, k) to many vectors (n, k)"""
+        matrices, vectors = self._as_blas(matrices), self._as_blas(vectors)
+        if matrices.ndim == 2:
+            # A single matrix: one matrix-matrix product A @ X.T, a single BLAS call for all the vectors
+            return self.matmat(vectors, matrices.T)
+        dtype = np.result_type(matrices, vectors)
+        out = self._get_buffer(vectors.shape[:-1] + matrices.shape[-2:-1], dtype)
+        method = self.method
+        if method == 'auto':
+            method = 'einsum' if matrices.shape[-1] <= small_matrix_size else 'matmul'
+        with blas_threads(self.num_threads):
+            if method == 'einsum':
+                np.einsum('...mk,...k->...m', matrices, vectors, out=out)
+            else:
+                np.matmul(matrices, vectors[..., np.newaxis], out=out[..., np.newaxis])
+        return out
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    matrices = [rng.integers(0, 10, (4, 4)) for _ in range(1000)]
+    vectors = [rng.integers(0, 10, 4) for _ in range(1000)]
+    expected = np.array([np.dot(A, x) for A, x in zip(matrices, vectors)])
+
+    for method in ('auto', 'matmul', 'einsum'):
+        products = BatchedProducts(method)
+        result = products.matvec(stack(matrices), stack(vectors))
+        assert np.array_equal(result, expected) and result.dtype == np.float64
+        assert products.matvec(stack(matrices), stack(vectors)) is result  # the buffer is reused
+        assert np.array_equal(products.matvec(matrices[0], stack(vectors)), stack(vectors) @ matrices[0].T)
+        assert np.array_equal(products.matmat(stack(matrices), stack(matrices, order='F')),
+                              np.array([A @ A for A in matrices]))
+    print("matvec and matmat match np.dot")
@@ -0,0 +1,61 @@
+from batched_linalg import BatchedProducts, blas_threads, stack
+
+import timeit
+from typing import Optional
+
+import numpy as np
+
+
+def best_time(function, repeat: int = 3) -> float:
+    function()
+    number = max(1, int(0.05 / max(timeit.timeit(function, number=1), 1e-7)))
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number
+
+
+def benchmark_matmul(sizes=(64, 256, 512), dtypes=(np.int32, np.int64, np.float32, np.float64),
+                     num_threads: Optional[int] = None):
+    """A @ B for every size, dtype and layout: integer products do not go through BLAS"""
+    rng = np.random.default_rng(0)
+    print(f"{'size':>6} {'dtype':>8} {'order':>5} {'seconds':>10} {'GFLOP/s':>9} {'vs float64 C':>13}")
+    with blas_threads(num_threads):
+        for size in sizes:
+            times = {}
+            for dtype in dtypes:
+                for order in ('C', 'F'):
+                    a = np.asarray(rng.integers(0, 10, (size, size)), dtype=dtype, order=order)
+                    b = np.asarray(rng.integers(0, 10, (size, size)), dtype=dtype, order=order)
+                    out = np.empty((size, size), dtype=dtype, order=order)
+                    times[np.dtype(dtype).name, order] = best_time(lambda: np.matmul(a, b, out=out))
+            reference = times['float64', 'C']
+            for (name, order), seconds in times.items():
+                print(f"{size:>6} {name:>8} {order:>5} {seconds:>10.6f} {2 * size**3 / seconds / 1e9:>9.2f} "
+                      f"{seconds / reference:>12.1f}x")
+
+
+def benchmark_matvec(num_products: int = 100_000, size: int = 4):
+    """Many small products as in blas_routines.ipynb: one np.dot per product against batched calls"""
+    rng = np.random.default_rng(0)
+    matrices = rng.integers(0, 10, (num_products, size, size))
+    vectors = rng.integers(0, 10, (num_products, size))
+    stacked_matrices, stacked_vectors = stack(matrices), stack(vectors)
+    results = {
+        "np.dot loop, int": best_time(lambda: [np.dot(A, x) for A, x in zip(matrices, vectors)], repeat=1),
+        "np.matmul, int": best_time(lambda: np.matmul(matrices, vectors[..., np.newaxis])),
+    }
+    for method in ('auto', 'matmul', 'einsum'):
+        products = BatchedProducts(method)
+        results[f"BatchedProducts {method}, float64"] = best_time(
+            lambda: products.matvec(stacked_matrices, stacked_vectors))
+    products = BatchedProducts()
+    results["BatchedProducts, one matrix for all vectors"] = best_time(
+        lambda: products.matvec(stacked_matrices[0], stacked_vectors))
+
+    print(f"{num_products} products of {size}x{size} matrices and vectors")
+    reference = results["np.dot loop, int"]
+    for name, seconds in results.items():
+        print(f"{name}: {seconds:.6f} s, speedup {reference / seconds:.1f}x")
+
+
+if __name__ == "__main__":
+    benchmark_matmul()
+    benchmark_matvec()
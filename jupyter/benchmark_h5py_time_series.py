@@ -0,0 +1,54 @@
+from h5py_time_series import get_time_keys, reduce_time_series
+
+import os
+import tempfile
+import timeit
+
+import h5py
+import numpy as np
+
+
+def generate_pseudo_file(filename: str, num_times: int = 400, shape=(51, 51, 101), num_vars: int = 3):
+    """Same layout as pseudo.h5: one group per variable, one dataset per time key"""
+    rng = np.random.default_rng(0)
+    with h5py.File(filename, 'w') as fo:
+        for varname in [f"Vel{index + 1}" for index in range(num_vars)]:
+            group = fo.create_group(varname)
+            for time in range(num_times):
+                group[f"{time * 0.01:012.6f}"] = rng.random(shape)
+
+
+def extract(fo, varname: str, timekeylist):
+    """The serial loop of h5py_parallel_read.ipynb"""
+    sumX = np.zeros(51)
+    for time in timekeylist:
+        sumX = sumX + fo[varname][time][:, 25, 50]
+    return sumX
+
+
+def benchmark(num_times: int = 400, repeat: int = 3):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, "pseudo.h5")
+        generate_pseudo_file(filename, num_times)
+        timekeylist = get_time_keys(filename, 'Vel1')
+
+        def serial():
+            with h5py.File(filename, 'r') as fo:
+                return extract(fo, 'Vel1', timekeylist)
+
+        expected = serial()
+        results = {"serial extract": min(timeit.repeat(serial, number=1, repeat=repeat))}
+        for workers in sorted({1, 2, 4, os.cpu_count()}):
+            assert np.allclose(reduce_time_series(filename, 'Vel1', workers=workers), expected)
+            results[f"reduce_time_series, {workers} workers"] = min(timeit.repeat(
+                lambda: reduce_time_series(filename, 'Vel1', time_keys=timekeylist, workers=workers),
+                number=1, repeat=repeat))
+
+    print(f"{num_times} time steps")
+    time_serial = results["serial extract"]
+    for name, seconds in results.items():
+        print(f"{name}: {seconds:.4f} s, speedup {time_serial / seconds:.1f}x")
+
+
+if __name__ == "__main__":
+    benchmark()
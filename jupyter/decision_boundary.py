@@ -0,0 +1,171 @@
+from typing import Callable, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+
+class DecisionGrid(NamedTuple):
+    xs: np.ndarray  # (nx,) grid coordinates along x1
+    ys: np.ndarray  # (ny,) grid coordinates along x2
+    Z: np.ndarray  # (ny, nx) predicted classes
+    num_predictions: int  # points actually passed to the model
+
+
+class _ChunkedModel:
+    """Calls the model on at most chunk_size points at a time, from a preallocated (chunk_size, 2) buffer"""
+    def __init__(self, model: Callable, xs: np.ndarray, ys: np.ndarray, chunk_size: int):
+        self.model = model
+        self.xs = xs
+        self.ys = ys
+        self.points = np.empty((chunk_size, 2))
+        self.num_predictions = 0
+
+    def predict(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        chunk_size = len(self.points)
+        predictions = []
+        for begin in range(0, len(rows), chunk_size):
+            size = min(chunk_size, len(rows) - begin)
+            points = self.points[:size]
+            np.take(self.xs, cols[begin:begin + size], out=points[:, 0])
+            np.take(self.ys, rows[begin:begin + size], out=points[:, 1])
+            predictions.append(np.asarray(self.model(points)).reshape(size))
+        self.num_predictions += len(rows)
+        return np.concatenate(predictions) if predictions else np.empty(0)
+
+
+def _grid_lines(size: int, step: int) -> np.ndarray:
+    """Indices of the grid lines of a level, the last index is always included"""
+    return np.unique(np.append(np.arange(0, size, step), size - 1))
+
+
+def _dilate(mask: np.ndarray) -> np.ndarray:
+    """Adds the 8 neighbours of every True cell, a boundary can cross a cell without changing its corners"""
+    padded = np.pad(mask, 1)
+    dilated = np.zeros_like(mask)
+    for row in range(3):
+        for col in range(3):
+            dilated |= padded[row:row + mask.shape[0], col:col + mask.shape[1]]
+    return dilated
+
+
+def evaluate_decision_grid(model: Callable, x_range: Tuple[float, float], y_range: Tuple[float, float],
+                           h: float = 0.01, coarse_step: int = 32, chunk_size: int = 65536,
+                           max_points: Optional[int] = None) -> DecisionGrid:
+    """
+    Classes predicted by model on the grid np.arange(x_min, x_max, h) x np.arange(y_min, y_max, h), as the
+    dense meshgrid of plot_decision_boundary, without predicting every point. model takes (k, 2) points
+    and returns k class labels.
+
+    The model is first evaluated every coarse_step points. Cells whose corners have the same class, and
+    are not next to a cell that has different classes, are filled with that class. The others are split
+    in halves down to single points. At most max_points predictions are made: coarse_step is widened until
+    the first level fits, and when a later level would exceed it, the cells of the last predicted level that
+    are still to refine are filled with the class of their top left corner. Raises ValueError when even the corners of the grid exceed max_points.
+    """
+    xs = np.arange(x_range[0], x_range[1], h)
+    ys = np.arange(y_range[0], y_range[1], h)
+    ny, nx = len(ys), len(xs)
+    if ny == 0 or nx == 0:
+        return DecisionGrid(xs, ys, np.empty((ny, nx)), 0)
+    chunked_model = _ChunkedModel(model, xs, ys, chunk_size)
+    Z: Optional[np.ndarray] = None
+    pending = np.ones((ny, nx), dtype=bool)  # points neither predicted nor filled yet
+
+    # A grid one point wide has no cells, every point is predicted
+    step = max(1, coarse_step) if min(ny, nx) > 1 else 1
+    if max_points is not None:
+        while len(_grid_lines(ny, step)) * len(_grid_lines(nx, step)) > max_points:
+            if min(ny, nx) == 1 or step >= max(ny, nx) - 1:
+                raise ValueError(f"max_points={max_points} is too small, the first level of the grid needs "
+                                 f"{len(_grid_lines(ny, step)) * len(_grid_lines(nx, step))} predictions")
+            step *= 2
+    while True:
+        rows, cols = _grid_lines(ny, step), _grid_lines(nx, step)
+        to_predict = pending[np.ix_(rows, cols)]
+        point_rows, point_cols = np.nonzero(to_predict)
+        point_rows, point_cols = rows[point_rows], cols[point_cols]
+        over_budget = max_points is not None and chunked_model.num_predictions + len(point_rows) > max_points
+        if over_budget:
+            # The first level always fits, fall back to the cells of the previous level, whose corners are known
+            rows, cols = known_rows, known_cols
+        else:
+            predictions = chunked_model.predict(point_rows, point_cols)
+            if Z is None:
+                Z = np.empty((ny, nx), dtype=predictions.dtype)
+            Z[point_rows, point_cols] = predictions
+            pending[point_rows, point_cols] = False
+            known_rows, known_cols = rows, cols
+        if not pending.any():
+            break
+
+        # Cells of this level, their corners are all known
+        corners = Z[np.ix_(rows, cols)]
+        refine = np.zeros((len(rows) - 1, len(cols) - 1), dtype=bool)
+        if not over_budget and step > 1:
+            top_left = corners[:-1, :-1]
+            refine = (top_left != corners[1:, :-1]) | (top_left != corners[:-1, 1:]) | (top_left != corners[1:, 1:])
+            refine = _dilate(refine)
+        # Fill the pending points of the other cells, one row of cells at a time
+        col_cells = np.minimum(np.searchsorted(cols, np.arange(nx), side='right') - 1, len(cols) - 2)
+        for cell_row in range(len(rows) - 1):
+            begin = rows[cell_row]
+            end = rows[cell_row + 1] + 1 if cell_row == len(rows) - 2 else rows[cell_row + 1]
+            fill = pending[begin:end] & ~refine[cell_row][col_cells]
+            if fill.any():
+                Z[begin:end][fill] = np.broadcast_to(corners[cell_row, col_cells], fill.shape)[fill]
+                pending[begin:end] &= ~fill
+        if over_budget or not pending.any():
+            break
+        step = max(1, step // 2)
+    return DecisionGrid(xs, ys, Z, chunked_model.num_predictions)
+
+
+def plot_decision_boundary(model: Callable, X: np.ndarray, y: np.ndarray, h: float = 0.01, **kwargs) -> DecisionGrid:
+    """plot_decision_boundary of sklearn_logistic_regression_example.ipynb on top of evaluate_decision_grid"""
+    import matplotlib.pyplot as plt
+
+    # Set min and max values and give it some padding
+    grid = evaluate_decision_grid(model, (X[0, :].min() - 1, X[0, :].max() + 1),
+                                  (X[1, :].min() - 1, X[1, :].max() + 1), h, **kwargs)
+    # Plot the contour and training examples
+    plt.contourf(grid.xs, grid.ys, grid.Z, cmap=plt.cm.Spectral)
+    plt.ylabel('x2')
+    plt.xlabel('x1')
+    plt.scatter(X[0, :], X[1, :], c=y, cmap=plt.cm.Spectral)
+    return grid
+
+
+if __name__ == "__main__":
+    import time
+
+    def dense(model, x_range, y_range, h):
+        xx, yy = np.meshgrid(np.arange(x_range[0], x_range[1], h), np.arange(y_range[0], y_range[1], h))
+        return model(np.c_[xx.ravel(), yy.ravel()]).reshape(xx.shape)
+
+    models = {
+        "logistic regression": lambda points: (points[:, 1] - 0.98 * points[:, 0] > 0.1).astype(int),
+        "two circles": lambda points: ((np.hypot(points[:, 0] - 3, points[:, 1] - 4) < 2)
+                                       | (np.hypot(points[:, 0] - 8, points[:, 1] - 7) < 1.5)).astype(int),
+    }
+    x_range, y_range = (0, 11), (0, 12)
+    for name, model in models.items():
+        start = time.perf_counter()
+        expected = dense(model, x_range, y_range, 0.01)
+        time_dense = time.perf_counter() - start
+        start = time.perf_counter()
+        grid = evaluate_decision_grid(model, x_range, y_range, 0.01)
+        time_adaptive = time.perf_counter() - start
+        assert np.array_equal(grid.Z, expected), name
+        print(f"{name}: {grid.num_predictions:,} of {expected.size:,} points predicted "
+              f"({grid.num_predictions / expected.size:.1%}), dense {time_dense:.3f} s, "
+              f"adaptive {time_adaptive:.3f} s")
+
+        capped = evaluate_decision_grid(model, x_range, y_range, 0.01, max_points=20_000)
+        assert capped.num_predictions <= 20_000
+        print(f"  capped at 20,000 predictions: {np.mean(capped.Z != expected):.3%} of the points differ")
+        assert evaluate_decision_grid(model, x_range, y_range, 0.01, max_points=200).num_predictions <= 200
+
+        # Every point of a capped grid holds a label predicted by the model
+        labels = lambda points: 5 + 2 * model(points)
+        for max_points in (500, 1000, 2000):
+            capped = evaluate_decision_grid(labels, x_range, y_range, 0.01, max_points=max_points)
+            assert np.isin(capped.Z, (5, 7)).all(), (name, max_points)
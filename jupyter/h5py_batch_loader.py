@@ -0,0 +1,175 @@
+import queue
+import threading
+from typing import Iterator, List, Optional, Tuple
+
+import h5py
+import numpy as np
+
+Range = Tuple[int, int]  # begin and end sample index of a contiguous read
+
+
+class BatchLoader:
+    """
+    Shuffled mini-batches (x, y) read straight from the HDF5 datasets of a catvnoncat style file, e.g.
+    train_set_x (m, 64, 64, 3) and train_set_y (m,). y is returned with shape (1, n) as in load_dataset.
+
+    Reads are chunk aware: the samples are cut in blocks of contiguous indices (the chunks of
+    x when it is chunked), the order of the blocks is shuffled and every batch is shuffled again
+    after reading, in place. A background thread reads read_ahead batches ahead straight into a fixed
+    pool of preallocated buffers, so that peak memory is a few batches whatever the size of the file.
+    The yielded arrays are views of these buffers: they are valid until the next batch is requested,
+    copy them to keep them longer.
+    """
+    def __init__(self, filename: str, x_name: str = 'train_set_x', y_name: str = 'train_set_y',
+                 batch_size: int = 32, shuffle: bool = True, seed: Optional[int] = None,
+                 normalize: bool = False, flatten: bool = False, block_size: Optional[int] = None,
+                 read_ahead: int = 2, drop_last: bool = False):
+        self.filename = filename
+        self.x_name = x_name
+        self.y_name = y_name
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+        self.normalize = normalize
+        self.flatten = flatten
+        self.read_ahead = read_ahead
+        self.drop_last = drop_last
+        with h5py.File(filename, 'r') as fo:
+            x, y = fo[x_name], fo[y_name]
+            if len(x) != len(y):
+                raise ValueError(f"{x_name} has {len(x)} samples but {y_name} has {len(y)}")
+            self.num_samples = len(x)
+            self.sample_shape = x.shape[1:]
+            # Normalized images are converted to float32 by HDF5 while reading, no uint8 copy is kept
+            self.x_dtype = np.dtype(np.float32) if normalize else x.dtype
+            self.y_dtype = y.dtype
+            if block_size is None:
+                block_size = x.chunks[0] if x.chunks is not None else max(1, batch_size // 8)
+        self.block_size = block_size
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return -(-self.num_samples // self.batch_size)
+
+    def _get_batch_ranges(self) -> List[List[Range]]:
+        """Contiguous ranges to read for every batch of the epoch, blocks can straddle two batches"""
+        blocks = [(begin, min(begin + self.block_size, self.num_samples))
+                  for begin in range(0, self.num_samples, self.block_size)]
+        if self.shuffle:
+            blocks = [blocks[index] for index in self.rng.permutation(len(blocks))]
+        batches: List[List[Range]] = [[]]
+        size = 0
+        for begin, end in blocks:
+            while begin < end:
+                if size == self.batch_size:
+                    batches.append([])
+                    size = 0
+                stop = min(end, begin + self.batch_size - size)
+                batches[-1].append((begin, stop))
+                size += stop - begin
+                begin = stop
+        if self.drop_last and size < self.batch_size:
+            batches.pop()
+        return [batch for batch in batches if batch]
+
+    def _allocate(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Buffers of a batch, the samples are read straight into them"""
+        return np.empty((self.batch_size,) + self.sample_shape, self.x_dtype), np.empty(self.batch_size, self.y_dtype)
+
+    @staticmethod
+    def _permute(array: np.ndarray, permutation: np.ndarray, sample: np.ndarray):
+        """array = array[permutation] in place, following the cycles of permutation with one sample of storage"""
+        visited = np.zeros(len(permutation), dtype=bool)
+        for start in range(len(permutation)):
+            if visited[start]:
+                continue
+            sample[...] = array[start]
+            index = start
+            while True:
+                visited[index] = True
+                source = permutation[index]
+                if source == start:
+                    array[index] = sample
+                    break
+                array[index] = array[source]
+                index = source
+
+    def _read_batch(self, x, y, ranges: List[Range], buffers, permutation: Optional[np.ndarray],
+                    samples: Tuple[np.ndarray, np.ndarray]) -> int:
+        x_batch, y_batch = buffers
+        offset = 0
+        for begin, end in ranges:
+            destination = np.s_[offset:offset + end - begin]
+            x.read_direct(x_batch, np.s_[begin:end], destination)
+            y.read_direct(y_batch, np.s_[begin:end], destination)
+            offset += end - begin
+        if permutation is not None:
+            self._permute(x_batch, permutation, samples[0])
+            self._permute(y_batch, permutation, samples[1])
+        if self.normalize:
+            x_batch[:offset] /= 255
+        return offset
+
+    def _produce(self, batch_ranges: List[List[Range]], free: queue.Queue, ready: queue.Queue,
+                 stop: threading.Event):
+        try:
+            with h5py.File(self.filename, 'r') as fo:
+                x, y = fo[self.x_name], fo[self.y_name]
+                samples = np.empty(self.sample_shape, self.x_dtype), np.empty((), self.y_dtype)
+                for ranges in batch_ranges:
+                    buffers = free.get()
+                    if stop.is_set():
+                        return
+                    size = sum(end - begin for begin, end in ranges)
+                    permutation = self.rng.permutation(size) if self.shuffle else None
+                    ready.put((buffers, self._read_batch(x, y, ranges, buffers, permutation, samples), None))
+        except Exception as exception:
+            ready.put((None, 0, exception))
+        ready.put(None)
+
+    def __iter__(self) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        free: queue.Queue = queue.Queue()
+        # read_ahead batches in flight, one being read and one held by the caller
+        for _ in range(self.read_ahead + 2):
+            free.put(self._allocate())
+        ready: queue.Queue = queue.Queue()
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, daemon=True,
+                                    args=(self._get_batch_ranges(), free, ready, stop))
+        producer.start()
+        try:
+            while True:
+                item = ready.get()
+                if item is None:
+                    return
+                buffers, size, exception = item
+                if exception is not None:
+                    raise exception
+                x_batch, y_batch = buffers[0][:size], buffers[1][:size]
+                if self.flatten:
+                    x_batch = x_batch.reshape(size, -1)
+                yield x_batch, y_batch.reshape(1, size)
+                free.put(buffers)
+        finally:
+            stop.set()
+            free.put(None)
+            producer.join()
+
+
+if __name__ == "__main__":
+    loader = BatchLoader('datasets/train_catvnoncat.h5', batch_size=64, seed=0, normalize=True, flatten=True)
+    with h5py.File('datasets/train_catvnoncat.h5', 'r') as data:
+        x_all = data['train_set_x'][:].reshape(len(data['train_set_x']), -1) / 255
+        y_all = data['train_set_y'][:]
+
+    # Every sample comes exactly once per epoch, with its label
+    seen = []
+    for x_batch, y_batch in loader:
+        assert x_batch.shape[1] == x_all.shape[1] and y_batch.shape == (1, len(x_batch))
+        for x_sample, label in zip(x_batch, y_batch[0]):
+            index = int(np.flatnonzero(np.all(np.isclose(x_all, x_sample), axis=1))[0])
+            assert y_all[index] == label
+            seen.append(index)
+    assert sorted(seen) == list(range(len(x_all))) and seen != sorted(seen)
+    print(f"{len(loader)} batches, {len(seen)} samples")
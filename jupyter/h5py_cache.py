@@ -0,0 +1,181 @@
+from h5py_time_series import reduce_time_series
+
+from collections import OrderedDict
+import hashlib
+import os
+import threading
+from typing import Callable, Dict, Hashable, Optional, Sequence, Tuple
+
+import h5py
+import numpy as np
+
+
+def _selection_key(selection) -> Hashable:
+    """Hashable form of a NumPy style selection, slices are not hashable before Python 3.12"""
+    if not isinstance(selection, tuple):
+        selection = (selection,)
+    key = []
+    for item in selection:
+        if isinstance(item, slice):
+            key.append(('slice', item.start, item.stop, item.step))
+        elif isinstance(item, (list, np.ndarray)):
+            # A boolean mask and an index array can hold the same values
+            item = np.asarray(item)
+            key.append(('array', item.dtype.kind, item.shape, tuple(item.ravel().tolist())))
+        elif item is Ellipsis:
+            key.append(('ellipsis',))
+        elif item is None:
+            key.append(('newaxis',))
+        else:
+            key.append(int(item))
+    return tuple(key)
+
+
+class H5Cache:
+    """
+    Memoizes reads and reductions of HDF5 datasets by (file path, mtime, dataset path, selection).
+    Results are kept in an LRU memory tier bounded by max_bytes and, when cache_dir is given, in .npy
+    files that are memory mapped back. Rewriting the HDF5 file changes its mtime, so stale entries
+    are never returned. Cached arrays are read-only, copy them before modifying them.
+    """
+    def __init__(self, max_bytes: int = 256 * 2**20, cache_dir: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.entries: 'OrderedDict[Hashable, np.ndarray]' = OrderedDict()
+        self.num_bytes = 0
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_read = 0  # read from the HDF5 files, i.e. on misses
+
+    def get_stats(self) -> Dict[str, int]:
+        return {'memory_hits': self.memory_hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'evictions': self.evictions, 'bytes_read': self.bytes_read, 'bytes_cached': self.num_bytes,
+                'entries': len(self.entries)}
+
+    def clear(self):
+        """Empties the memory tier, the files of the disk tier are kept"""
+        with self.lock:
+            self.entries.clear()
+            self.num_bytes = 0
+
+    @staticmethod
+    def _get_file_key(filename: str) -> Tuple[str, int, int]:
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        return path, stat.st_mtime_ns, stat.st_size
+
+    def _get_disk_path(self, key: Hashable) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha1(repr(key).encode()).hexdigest() + '.npy')
+
+    def _store_memory(self, key: Hashable, array: np.ndarray):
+        if array.nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = array
+            self.num_bytes += array.nbytes
+            while self.num_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.num_bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def memoize(self, filename: str, name: Hashable, compute: Callable[[], np.ndarray],
+                get_bytes_read: Optional[Callable[[np.ndarray], int]] = None) -> np.ndarray:
+        """
+        Result of compute() for the current version of filename, computed once per name.
+        get_bytes_read(result) gives the bytes compute() read from the file, by default the size of the result.
+        """
+        key = (self._get_file_key(filename), name)
+        with self.lock:
+            array = self.entries.get(key)
+            if array is not None:
+                self.entries.move_to_end(key)
+                self.memory_hits += 1
+                return array
+
+        if self.cache_dir is not None:
+            path = self._get_disk_path(key)
+            if os.path.exists(path):
+                array = np.load(path, mmap_mode='r')
+                self.disk_hits += 1
+                self._store_memory(key, array)
+                return array
+
+        array = np.asarray(compute())
+        self.misses += 1
+        self.bytes_read += array.nbytes if get_bytes_read is None else get_bytes_read(array)
+        array.setflags(write=False)
+        if self.cache_dir is not None:
+            path_tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(path_tmp, 'wb') as fp:
+                np.save(fp, array)
+            os.replace(path_tmp, path)
+        self._store_memory(key, array)
+        return array
+
+    def read(self, filename: str, dataset_path: str, selection=np.s_[...]) -> np.ndarray:
+        """fo[dataset_path][selection]"""
+        def compute():
+            with h5py.File(filename, 'r') as fo:
+                return fo[dataset_path][selection]
+        return self.memoize(filename, ('read', dataset_path, _selection_key(selection)), compute)
+
+    def reduce_time_series(self, filename: str, varname: str, selection=np.s_[:, 25, 50], operation: str = 'sum',
+                           time_keys: Optional[Sequence[str]] = None, workers: Optional[int] = None) -> np.ndarray:
+        """Memoized h5py_time_series.reduce_time_series"""
+        name = ('reduce', varname, _selection_key(selection), operation,
+                None if time_keys is None else tuple(time_keys))
+
+        def get_bytes_read(result: np.ndarray) -> int:
+            # The selection of every time step was read in the dtype of the dataset
+            with h5py.File(filename, 'r') as fo:
+                group = fo[varname]
+                keys = list(group.keys()) if time_keys is None else time_keys
+                return result.size * group[keys[0]].dtype.itemsize * len(keys)
+        return self.memoize(filename, name, lambda: reduce_time_series(
+            filename, varname, selection, operation, time_keys, workers), get_bytes_read)
+
+
+if __name__ == "__main__":
+    import tempfile
+    import time
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, "pseudo.h5")
+        rng = np.random.default_rng(0)
+        with h5py.File(filename, 'w') as fo:
+            for step in range(200):
+                fo[f"Vel1/{step:06d}"] = rng.random((51, 51, 101))
+
+        cache = H5Cache(max_bytes=2 * 2**20, cache_dir=os.path.join(tmp_dir, "cache"))
+        for attempt in range(2):
+            start = time.perf_counter()
+            sumX = cache.reduce_time_series(filename, 'Vel1', workers=1)
+            hyperslab = cache.read(filename, 'Vel1/000000', np.s_[:, 25, :])
+            print(f"attempt {attempt}: {time.perf_counter() - start:.4f} s")
+        # 200 time steps of 51 values for the reduction and 51 x 101 values for the hyperslab
+        assert cache.bytes_read == (200 * 51 + 51 * 101) * 8
+        assert np.array_equal(hyperslab, cache.read(filename, 'Vel1/000000')[:, 25, :])
+        print(cache.get_stats())
+
+        # A new cache instance finds the results in the disk tier
+        cache = H5Cache(cache_dir=os.path.join(tmp_dir, "cache"))
+        assert np.array_equal(cache.reduce_time_series(filename, 'Vel1', workers=1), sumX)
+        assert cache.disk_hits == 1
+
+        # Rewriting the file invalidates its entries
+        time.sleep(0.01)
+        with h5py.File(filename, 'a') as fo:
+            fo['Vel1/000000'][...] = 0
+        assert cache.read(filename, 'Vel1/000000', np.s_[:, 25, :]).sum() == 0
+        assert cache.misses == 1
+
+        # A boolean mask and an index array with the same values are different selections
+        assert cache.read(filename, 'Vel1/000001', np.array([False, True] + [False] * 49)).shape == (1, 51, 101)
+        assert cache.read(filename, 'Vel1/000001', np.array([0, 1])).shape == (2, 51, 101)
@@ -0,0 +1,120 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import h5py
+from h5py import h5d, h5s
+import numpy as np
+
+try:
+    # Private module of h5py, parses a selection once for all the time steps
+    from h5py._hl import selections
+except ImportError:
+    selections = None
+
+# In place accumulation of a time step into the partial result
+reductions = {
+    'sum': np.add,
+    'mean': np.add,
+    'min': np.minimum,
+    'max': np.maximum,
+}
+
+
+def get_time_keys(filename: str, varname: str) -> List[str]:
+    with h5py.File(filename, 'r') as fo:
+        return list(fo[varname].keys())
+
+
+def _get_reader(group: h5py.Group, dataset: h5py.Dataset, selection, buffer: np.ndarray) -> Callable[[str], None]:
+    """
+    Reads the selection of a time step into buffer. The selection is parsed once into file and memory
+    dataspaces and read with the low level API, or, when the private h5py selections module is not
+    available, read with the public Dataset.read_direct that parses it again at every time step.
+    """
+    try:
+        # All time steps share the dataspace of the first one
+        parsed_selection = selections.select(dataset.shape, selection, dataset)
+        file_space = parsed_selection.id
+        memory_space = h5s.create_simple(parsed_selection.mshape)
+    except AttributeError:
+        return lambda time: group[time].read_direct(buffer, selection)
+    return lambda time: h5d.open(group.id, time.encode()).read(memory_space, file_space, buffer)
+
+
+def _reduce_time_keys(task) -> Tuple[np.ndarray, int]:
+    """
+    Pool worker: opens its own file handle and reduces the selection over a chunk of time keys,
+    every time step is read into the same preallocated buffer.
+    """
+    filename, varname, time_keys, selection, operation = task
+    accumulate = reductions[operation]
+    with h5py.File(filename, 'r') as fo:
+        group = fo[varname]
+        dataset = group[time_keys[0]]
+        result = np.asarray(dataset[selection], dtype=np.float64)
+        buffer = np.empty_like(result)
+        read = _get_reader(group, dataset, selection, buffer)
+        for time in time_keys[1:]:
+            read(time)
+            accumulate(result, buffer, out=result)
+    return result, len(time_keys)
+
+
+def _split(time_keys: Sequence[str], num_chunks: int) -> List[List[str]]:
+    """Contiguous chunks of about the same size, so that every worker reads neighbouring groups"""
+    num_chunks = max(1, min(num_chunks, len(time_keys)))
+    bounds = np.linspace(0, len(time_keys), num_chunks + 1).astype(int)
+    return [list(time_keys[begin:end]) for begin, end in zip(bounds[:-1], bounds[1:])]
+
+
+def reduce_time_series(filename: str, varname: str, selection=np.s_[:, 25, 50], operation: str = 'sum',
+                       time_keys: Optional[Sequence[str]] = None, workers: Optional[int] = None) -> np.ndarray:
+    """
+    Reduces fo[varname][time][selection] over the time keys (all of them by default) with sum, mean,
+    min or max. The time keys are split between workers processes, workers=1 runs in this process.
+    """
+    if operation not in reductions:
+        raise ValueError(f"Unknown operation {operation}, expected one of {list(reductions)}")
+    if time_keys is None:
+        time_keys = get_time_keys(filename, varname)
+    if not time_keys:
+        raise ValueError(f"No time keys to reduce in {varname}")
+    workers = workers if workers is not None else os.cpu_count()
+    tasks = [(filename, varname, chunk, selection, operation) for chunk in _split(time_keys, workers)]
+
+    if len(tasks) == 1:
+        partials = [_reduce_time_keys(tasks[0])]
+    else:
+        with ProcessPoolExecutor(max_workers=len(tasks)) as executor:
+            partials = list(executor.map(_reduce_time_keys, tasks))
+
+    accumulate = reductions[operation]
+    result, count = partials[0]
+    for partial, partial_count in partials[1:]:
+        accumulate(result, partial, out=result)
+        count += partial_count
+    if operation == 'mean':
+        result /= count
+    return result
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, "pseudo.h5")
+        rng = np.random.default_rng(0)
+        with h5py.File(filename, 'w') as fo:
+            for time in range(20):
+                fo[f"Vel1/{time:06d}"] = rng.random((51, 51, 101))
+        with h5py.File(filename, 'r') as fo:
+            values = np.stack([fo['Vel1'][time][:, 25, 50] for time in fo['Vel1']])
+        expected = {'sum': values.sum(axis=0), 'mean': values.mean(axis=0),
+                    'min': values.min(axis=0), 'max': values.max(axis=0)}
+        for operation, expected_result in expected.items():
+            for workers in (1, 4):
+                result = reduce_time_series(filename, 'Vel1', operation=operation, workers=workers)
+                assert result.shape == (51,)
+                assert np.allclose(result, expected_result), (operation, workers)
+        print("sum, mean, min and max match with 1 and 4 workers")
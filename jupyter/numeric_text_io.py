@@ -0,0 +1,146 @@
+import json
+import os
+from typing import Iterator, Optional
+import warnings
+
+import numpy as np
+
+whitespace = (b' ', b'\n', b'\t', b'\r')
+
+
+def write_values(filename: str, values, values_per_line: int = 5, fmt: str = '%d', delimiter: str = ' ',
+                 lines_per_chunk: int = 100_000):
+    """
+    Writes the values as whitespace delimited text, values_per_line per line.
+    Every chunk of lines is formatted by a single % operation instead of one write per value.
+    """
+    values = np.asarray(values).ravel()
+    num_full_lines = len(values) // values_per_line
+    line_format = delimiter.join([fmt] * values_per_line) + '\n'
+    with open(filename, 'w') as fp:
+        for begin in range(0, num_full_lines, lines_per_chunk):
+            end = min(begin + lines_per_chunk, num_full_lines)
+            chunk = values[begin * values_per_line:end * values_per_line]
+            fp.write((line_format * (end - begin)) % tuple(chunk.tolist()))
+        rest = values[num_full_lines * values_per_line:]
+        if len(rest):
+            fp.write(delimiter.join([fmt] * len(rest)) % tuple(rest.tolist()) + '\n')
+
+
+def _parse(text: bytes, dtype) -> np.ndarray:
+    text = text.strip()
+    if not text:
+        # fromstring parses a string of whitespace as a single 0
+        return np.empty(0, dtype)
+    with warnings.catch_warnings():
+        # Older NumPy only emits a DeprecationWarning on unparsable data and returns the values read so far
+        warnings.simplefilter('error', DeprecationWarning)
+        try:
+            return np.fromstring(text.decode('ascii'), dtype=dtype, sep=' ')
+        except (DeprecationWarning, UnicodeDecodeError) as error:
+            raise ValueError(f"Not a whitespace delimited {np.dtype(dtype)} chunk: {error}") from error
+
+
+def iter_value_chunks(filename: str, dtype=np.int64, chunk_bytes: int = 64 * 2**20) -> Iterator[np.ndarray]:
+    """Parses the file chunk by chunk, chunks are cut after the last whitespace so that no value is split"""
+    rest = b''
+    with open(filename, 'rb') as fp:
+        while True:
+            data = fp.read(chunk_bytes)
+            if not data:
+                break
+            data = rest + data
+            cut = max(data.rfind(separator) for separator in whitespace) + 1
+            rest = data[cut:]
+            values = _parse(data[:cut], dtype)
+            if len(values):
+                yield values
+    values = _parse(rest, dtype)
+    if len(values):
+        yield values
+
+
+def read_values(filename: str, dtype=np.int64, chunk_bytes: int = 64 * 2**20) -> np.ndarray:
+    """All the values of a whitespace delimited file as a 1D array"""
+    chunks = list(iter_value_chunks(filename, dtype, chunk_bytes))
+    if not chunks:
+        return np.empty(0, dtype)
+    return chunks[0] if len(chunks) == 1 else np.concatenate(chunks)
+
+
+def _get_sidecar_paths(filename: str):
+    return filename + '.bin', filename + '.bin.json'
+
+
+def _get_source_info(filename: str, dtype) -> dict:
+    stat = os.stat(filename)
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'dtype': np.dtype(dtype).str}
+
+
+def write_sidecar(filename: str, dtype=np.int64, chunk_bytes: int = 64 * 2**20) -> str:
+    """
+    Converts the text file into a raw binary file next to it, filename.bin, along with filename.bin.json
+    recording the dtype and the version of the text file it was made from. Returns the binary file name.
+    """
+    path_binary, path_info = _get_sidecar_paths(filename)
+    path_tmp = f"{path_binary}.{os.getpid()}.tmp"
+    with open(path_tmp, 'wb') as fp:
+        for values in iter_value_chunks(filename, dtype, chunk_bytes):
+            values.tofile(fp)
+    os.replace(path_tmp, path_binary)
+    with open(path_info, 'w') as fp:
+        json.dump(_get_source_info(filename, dtype), fp)
+    return path_binary
+
+
+def load_values(filename: str, dtype=np.int64, chunk_bytes: int = 64 * 2**20, mmap_mode: Optional[str] = 'r'):
+    """
+    Values of the text file, memory mapped from its binary sidecar. The sidecar is (re)built when it is
+    missing or was made from another version of the file or for another dtype.
+    """
+    path_binary, path_info = _get_sidecar_paths(filename)
+    try:
+        with open(path_info) as fp:
+            is_valid = json.load(fp) == _get_source_info(filename, dtype) and os.path.exists(path_binary)
+    except (OSError, ValueError):
+        is_valid = False
+    if not is_valid:
+        write_sidecar(filename, dtype, chunk_bytes)
+    if os.path.getsize(path_binary) == 0:
+        # An empty file cannot be memory mapped
+        return np.empty(0, dtype)
+    if mmap_mode is None:
+        return np.fromfile(path_binary, dtype)
+    return np.memmap(path_binary, dtype=dtype, mode=mmap_mode)
+
+
+if __name__ == "__main__":
+    import tempfile
+    import time
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, 'file.dat')
+        array = np.random.randint(0, 10, (23,))
+        write_values(filename, array)
+        with open(filename) as fp:
+            assert [len(line.split()) for line in fp] == [5, 5, 5, 5, 3]
+        assert np.array_equal(read_values(filename), array)
+        assert np.array_equal(read_values(filename, chunk_bytes=3), array)
+
+        array = np.random.default_rng(0).integers(-10**6, 10**6, 5_000_000)
+        start = time.perf_counter()
+        write_values(filename, array, values_per_line=8)
+        print(f"write {len(array)} values: {time.perf_counter() - start:.3f} s")
+        start = time.perf_counter()
+        assert np.array_equal(read_values(filename, chunk_bytes=2**20), array)
+        print(f"read: {time.perf_counter() - start:.3f} s")
+        start = time.perf_counter()
+        assert np.array_equal(load_values(filename), array)
+        print(f"first load, sidecar written: {time.perf_counter() - start:.3f} s")
+        start = time.perf_counter()
+        assert np.array_equal(load_values(filename), array)
+        print(f"next loads from the sidecar: {time.perf_counter() - start:.3f} s")
+
+        values = np.linspace(0, 1, 11)
+        write_values(filename, values, fmt='%.17g')
+        assert np.array_equal(load_values(filename, dtype=np.float64), values)